@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/attention.py [--n_layer 12] [--batch_size 1]
+#
+# Times model.model with 124M-sized random weights in the two shapes attention
+# runs in: a training step (forward and backward over n_ctx tokens) and one
+# step of incremental decoding (one new token after n_ctx - 1 cached ones),
+# with the cache concatenated and preallocated.
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import model
+
+parser = argparse.ArgumentParser(
+    description='Benchmark attention in training and decoding.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--batch_size', metavar='SIZE', type=int, default=1, help='Batch size')
+parser.add_argument('--n_layer', metavar='N', type=int, default=12, help='Number of layers')
+parser.add_argument('--n_ctx', metavar='N', type=int, default=1024, help='Sequence length for training')
+parser.add_argument('--repeat', metavar='N', type=int, default=5, help='Take the best of N runs')
+
+
+def bench(sess, fetches, feed_dict, repeat):
+    sess.run(fetches, feed_dict=feed_dict)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sess.run(fetches, feed_dict=feed_dict)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = parser.parse_args()
+    tf.disable_eager_execution()
+    hparams = model.default_hparams()
+    hparams.override_from_dict(dict(n_vocab=50257, n_ctx=args.n_ctx, n_layer=args.n_layer))
+    rng = np.random.RandomState(0)
+    batch, length = args.batch_size, args.n_ctx
+
+    tokens = tf.placeholder(tf.int32, [batch, None])
+    train_output = model.model(hparams=hparams, X=tokens)
+    loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=tokens[:, 1:], logits=train_output['logits'][:, :-1]))
+    train_step = tf.gradients(loss, tf.trainable_variables())
+
+    # One token at a time, as in sample.sample_sequence
+    new_tokens = tf.placeholder(tf.int32, [batch, 1])
+    past = tf.placeholder(tf.float32, model.past_shape(hparams=hparams, batch_size=batch, sequence=length - 1))
+    concat_step = model.model(hparams=hparams, X=new_tokens, past=past, logits_positions=[-1])
+    buffer = tf.placeholder(tf.float32, model.past_buffer_shape(hparams=hparams, batch_size=batch, sequence=length))
+    buffered_step = model.model(hparams=hparams, X=new_tokens, past=buffer, past_length=length - 1, logits_positions=[-1])
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        feed = {tokens: rng.randint(0, hparams.n_vocab, [batch, length])}
+        t_train = bench(sess, train_step, feed, args.repeat)
+        print('train   seq {:5}  {:9.1f} ms/step'.format(length, t_train * 1000))
+
+        new_token = rng.randint(0, hparams.n_vocab, [batch, 1])
+        feed = {new_tokens: new_token, past: rng.normal(size=past.shape.as_list()).astype(np.float32)}
+        t_concat = bench(sess, concat_step, feed, args.repeat * 10)
+        print('decode  seq     1  {:9.2f} ms/token (concatenated cache)'.format(t_concat * 1000))
+        feed = {new_tokens: new_token, buffer: rng.normal(size=buffer.shape.as_list()).astype(np.float32)}
+        t_buffered = bench(sess, buffered_step, feed, args.repeat * 10)
+        print('decode  seq     1  {:9.2f} ms/token (preallocated cache)'.format(t_buffered * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/bpe.py [--path dataset/cleaned] [--model_name 124M]
+#
+# Compares the string BPE loop (Encoder.bpe) against the integer engine
+# (Encoder.bpe_ids) on the pre-tokenized words of a dataset, with cold caches
+# so every word goes through the merge loop.
+
+import argparse
+import glob
+import os
+import time
+
+import regex as re
+
+import encoder
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the BPE merge engines.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--path', metavar='PATH', type=str, default='dataset/cleaned', help='Directory or glob of text files to encode')
+parser.add_argument('--model_name', metavar='MODEL', type=str, default='124M', help='Pretrained model name')
+parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
+parser.add_argument('--repeat', metavar='N', type=int, default=5, help='Take the best of N runs')
+
+
+def read_words(enc, path):
+    if os.path.isdir(path):
+        path = os.path.join(path, '*')
+    words = []
+    for fname in sorted(glob.glob(path)):
+        with open(fname, 'r', encoding='utf-8') as fp:
+            words.extend(re.findall(enc.pat, fp.read()))
+    return words
+
+
+def bench(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = parser.parse_args()
+    enc = encoder.get_encoder(args.model_name, models_dir=args.models_dir)
+    words = read_words(enc, args.path)
+    unique = list(dict.fromkeys(words))
+    print('{} words, {} unique'.format(len(words), len(unique)))
+
+    def run_strings():
+        enc.cache.clear()
+        for word in unique:
+            enc.bpe(''.join(enc.byte_encoder[b] for b in word.encode('utf-8')))
+
+    def run_ids():
+        enc.ids_cache.clear()
+        for word in unique:
+            enc.bpe_ids(word)
+
+    for word in unique:
+        expected = [enc.encoder[t] for t in enc.bpe(''.join(enc.byte_encoder[b] for b in word.encode('utf-8'))).split(' ')]
+        assert list(enc.bpe_ids(word)) == expected, word
+
+    t_strings = bench(run_strings, args.repeat)
+    t_ids = bench(run_ids, args.repeat)
+    print('bpe      {:8.1f} ms  {:10.0f} words/s'.format(t_strings * 1000, len(unique) / t_strings))
+    print('bpe_ids  {:8.1f} ms  {:10.0f} words/s'.format(t_ids * 1000, len(unique) / t_ids))
+    print('speedup  {:.2f}x'.format(t_strings / t_ids))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/dataset.py [--tokens 20000000] [--chunks 1000]
+#
+# Writes a random dataset both as an .npz of int64 chunks (like the existing
+# dataset/training_data_*.npz) and as a token store (see
+# load_dataset.save_tokens), then times load_dataset and a Sampler on each, and
+# reports how much resident memory each added (Linux only). Every load is in a
+# fresh process, so that the memory is its own.
+
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+import numpy as np
+
+parser = argparse.ArgumentParser(
+    description='Benchmark loading a dataset from .npz and from a token store.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--tokens', metavar='N', type=int, default=20000000, help="Number of tokens in the dataset")
+parser.add_argument('--chunks', metavar='N', type=int, default=1000, help='Number of chunks they are split into')
+parser.add_argument('--batches', metavar='N', type=int, default=1000, help='Number of [1, 1024] samples to time')
+
+
+def resident():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(path, batches, results):
+    from load_dataset import load_dataset, Sampler
+
+    before = resident()
+    start = time.perf_counter()
+    sampler = Sampler(load_dataset(None, path, 0))
+    loaded = time.perf_counter()
+    loaded_resident = resident()
+    for _ in range(batches):
+        np.asarray(sampler.sample(1024), dtype=np.int32)
+    sampled = time.perf_counter()
+    results.put((loaded - start, (loaded_resident - before) / 2**20,
+                 (sampled - loaded) / batches * 1e6, (resident() - loaded_resident) / 2**20))
+
+
+def main():
+    args = parser.parse_args()
+    from load_dataset import save_tokens
+
+    rng = np.random.RandomState(0)
+    bounds = np.linspace(0, args.tokens, args.chunks + 1).astype(np.int64)
+    chunks = [rng.randint(0, 50257, size=end - start) for start, end in zip(bounds[:-1], bounds[1:])]
+    ctx = mp.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {'npz': os.path.join(tmp, 'dataset.npz'), 'tokens': os.path.join(tmp, 'dataset.tokens')}
+        np.savez_compressed(paths['npz'], *chunks)
+        save_tokens(paths['tokens'], chunks)
+        del chunks
+        print('{:8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('', 'file MB', 'load s', 'load MB', 'sample us', 'sample MB'))
+        for name, path in paths.items():
+            results = ctx.Queue()
+            p = ctx.Process(target=run, args=(path, args.batches, results))
+            p.start()
+            row = results.get()
+            p.join()
+            print('{:8} {:10.0f} {:10.2f} {:10.0f} {:10.1f} {:10.0f}'.format(name, os.path.getsize(path) / 2**20, *row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/numpy_model.py [--model_name oscar3] [--length 40]
+#
+# Checks that np_model gives the same logits as the TensorFlow model for a
+# checkpoint, then times generating from a chat-length context with both.
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import model, sample, np_model, np_sample
+
+parser = argparse.ArgumentParser(
+    description='Compare the NumPy model against the TensorFlow model.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--model_name', metavar='MODEL', type=str, default='oscar3', help='Pretrained model name')
+parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
+parser.add_argument('--batch_size', metavar='SIZE', type=int, default=1, help='Number of rows generated together')
+parser.add_argument('--context', metavar='N', type=int, default=20, help='Context length in tokens')
+parser.add_argument('--length', metavar='N', type=int, default=40, help='Number of tokens to generate')
+parser.add_argument('--tolerance', type=float, default=1e-4, help='Largest allowed logit difference, relative to the largest logit')
+
+
+def main():
+    args = parser.parse_args()
+    model_dir = os.path.join(args.models_dir, args.model_name)
+    hparams = np_model.default_hparams()
+    with open(os.path.join(model_dir, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    ckpt = np_model.latest_checkpoint(model_dir)
+
+    start = time.perf_counter()
+    params = np_model.load_params(ckpt)
+    print('numpy load  {:8.2f} s'.format(time.perf_counter() - start))
+
+    rng = np.random.RandomState(0)
+    tokens = rng.randint(0, hparams.n_vocab, [args.batch_size, args.context])
+
+    tf.disable_eager_execution()
+    with tf.Session(graph=tf.Graph()) as sess:
+        start = time.perf_counter()
+        context = tf.placeholder(tf.int32, [args.batch_size, None])
+        logits = model.model(hparams=hparams, X=context)['logits']
+        output = sample.sample_sequence(hparams=hparams, length=args.length, context=context,
+                                        batch_size=args.batch_size, top_k=1)
+        tf.train.Saver().restore(sess, ckpt)
+        print('tf load     {:8.2f} s'.format(time.perf_counter() - start))
+
+        expected = sess.run(logits, feed_dict={context: tokens})
+        actual = np_model.model(params, hparams, tokens)['logits']
+        error = np.abs(expected - actual).max() / np.abs(expected).max()
+        print('logits      {:8.2e} relative difference'.format(error))
+        assert error < args.tolerance
+
+        sess.run(output, feed_dict={context: tokens})
+        start = time.perf_counter()
+        sess.run(output, feed_dict={context: tokens})
+        t_tf = time.perf_counter() - start
+
+    start = time.perf_counter()
+    np_sample.sample_sequence(params=params, hparams=hparams, length=args.length, context=tokens, top_k=1)
+    t_np = time.perf_counter() - start
+    print('tf          {:8.2f} ms/token'.format(t_tf / args.length * 1000))
+    print('numpy       {:8.2f} ms/token'.format(t_np / args.length * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/precision.py [--n_layer 12] [--precision float32 bfloat16 float16]
+#
+# Times model.model with 124M-sized random weights in each precision, for a
+# training step (forward and backward over n_ctx tokens) and for sampling with
+# sample.sample_sequence, and reports the peak memory of each. Every run is in
+# a fresh process, so that the peak memory is its own.
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import numpy as np
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the model in each precision.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--precision', type=str, nargs='+', default=['float32', 'bfloat16', 'float16'], help='Precisions to compare')
+parser.add_argument('--batch_size', metavar='SIZE', type=int, default=1, help='Batch size')
+parser.add_argument('--n_layer', metavar='N', type=int, default=12, help='Number of layers')
+parser.add_argument('--n_ctx', metavar='N', type=int, default=1024, help='Sequence length for training')
+parser.add_argument('--length', metavar='N', type=int, default=64, help='Number of tokens to sample')
+parser.add_argument('--repeat', metavar='N', type=int, default=3, help='Take the best of N runs')
+
+
+def bench(sess, fetches, feed_dict, repeat):
+    sess.run(fetches, feed_dict=feed_dict)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sess.run(fetches, feed_dict=feed_dict)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(mode, precision, args, results):
+    import tensorflow.compat.v1 as tf
+    import model, sample
+
+    tf.disable_eager_execution()
+    hparams = model.default_hparams()
+    hparams.override_from_dict(dict(n_vocab=50257, n_ctx=args.n_ctx, n_layer=args.n_layer))
+    dtype = model.PRECISIONS[precision]
+    rng = np.random.RandomState(0)
+    batch = args.batch_size
+
+    if mode == 'train':
+        tokens = tf.placeholder(tf.int32, [batch, args.n_ctx])
+        logits = model.model(hparams=hparams, X=tokens, dtype=dtype)['logits']
+        loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=tokens[:, 1:], logits=logits[:, :-1]))
+        fetches = tf.gradients(loss, tf.trainable_variables())
+        feed = {tokens: rng.randint(0, hparams.n_vocab, [batch, args.n_ctx])}
+        generated = batch * args.n_ctx
+    else:
+        context = tf.placeholder(tf.int32, [batch, None])
+        fetches = sample.sample_sequence(hparams=hparams, length=args.length, context=context, top_k=40, dtype=dtype)
+        feed = {context: rng.randint(0, hparams.n_vocab, [batch, 16])}
+        generated = batch * args.length
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        elapsed = bench(sess, fetches, feed, args.repeat)
+    results.put((generated / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    args = parser.parse_args()
+    ctx = mp.get_context('spawn')
+    print('{:10} {:>14} {:>10} {:>14} {:>10}'.format('', 'train tok/s', 'train MB', 'sample tok/s', 'sample MB'))
+    for precision in args.precision:
+        row = []
+        for mode in ('train', 'sample'):
+            results = ctx.Queue()
+            p = ctx.Process(target=run, args=(mode, precision, args, results))
+            p.start()
+            row.extend(results.get())
+            p.join()
+        print('{:10} {:14.1f} {:10.0f} {:14.1f} {:10.0f}'.format(precision, *row))
+
+
+if __name__ == '__main__':
+    main()
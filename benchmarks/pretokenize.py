@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/pretokenize.py [--path dataset/cleaned] [--model_name 124M]
+#
+# Compares Encoder.encode with its ASCII fast path against the general
+# Unicode pattern, on chat-length lines and on whole documents. Caches are
+# warm, as they are in the bot and when encoding a large dataset.
+
+import argparse
+import glob
+import os
+import time
+
+import encoder
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the ASCII pre-tokenizer fast path.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--path', metavar='PATH', type=str, default='dataset/cleaned', help='Directory or glob of text files to encode')
+parser.add_argument('--model_name', metavar='MODEL', type=str, default='124M', help='Pretrained model name')
+parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
+parser.add_argument('--repeat', metavar='N', type=int, default=5, help='Take the best of N runs')
+
+
+def bench(fn, texts, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = parser.parse_args()
+    enc = encoder.get_encoder(args.model_name, models_dir=args.models_dir)
+    path = os.path.join(args.path, '*') if os.path.isdir(args.path) else args.path
+    documents = []
+    for fname in sorted(glob.glob(path)):
+        with open(fname, 'r', encoding='utf-8') as fp:
+            documents.append(fp.read())
+    lines = [line for document in documents for line in document.splitlines() if line.strip()]
+
+    def encode_general(text):
+        bpe_tokens = []
+        for token in enc.pat.findall(text):
+            bpe_tokens.extend(enc.bpe_ids(token))
+        return bpe_tokens
+
+    for text in lines + documents:
+        assert enc.encode(text) == encode_general(text)
+
+    for name, texts in (('chat', lines), ('document', documents)):
+        chars = sum(len(text) for text in texts)
+        ascii_share = sum(text.isascii() for text in texts) / len(texts)
+        t_general = bench(encode_general, texts, args.repeat)
+        t_fast = bench(enc.encode, texts, args.repeat)
+        print('{}: {} texts, {:.0f} chars avg, {:.0%} ascii'.format(name, len(texts), chars / len(texts), ascii_share))
+        print('  general  {:8.2f} us/text  {:6.2f} MB/s'.format(t_general / len(texts) * 1e6, chars / t_general / 1e6))
+        print('  fast     {:8.2f} us/text  {:6.2f} MB/s'.format(t_fast / len(texts) * 1e6, chars / t_fast / 1e6))
+        print('  speedup  {:.2f}x'.format(t_general / t_fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/sampling.py [--batch_size 1] [--top_p 0.9]
+#
+# Times one sampling step (filtering the logits and drawing a token) for each
+# mode of sample_sequence: top-k, top-p sorting the whole vocabulary, top-p
+# over the largest logits only, and top-k followed by top-p. The logits are
+# synthetic, with a Zipf-like distribution over a GPT-2 sized vocabulary.
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import sample
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the sampling modes.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--batch_size', metavar='SIZE', type=int, default=1, help='Number of rows sampled together')
+parser.add_argument('--n_vocab', metavar='N', type=int, default=50257, help='Vocabulary size')
+parser.add_argument('--top_k', metavar='K', type=int, default=40, help='K for top-k sampling')
+parser.add_argument('--top_p', metavar='P', type=float, default=0.9, help='P for top-p sampling')
+parser.add_argument('--zipf', metavar='S', type=float, default=1.6, help='Exponent of the synthetic distribution (smaller is flatter)')
+parser.add_argument('--steps', metavar='N', type=int, default=200, help='Number of timed steps')
+
+
+def synthetic_logits(rng, batch_size, n_vocab, zipf):
+    ranks = np.arange(1, n_vocab + 1)
+    logits = np.stack([rng.permutation(-zipf * np.log(ranks)) for _ in range(batch_size)])
+    return (logits + rng.normal(scale=0.1, size=logits.shape)).astype(np.float32)
+
+
+def main():
+    args = parser.parse_args()
+    tf.disable_eager_execution()
+    rng = np.random.RandomState(0)
+    feed = synthetic_logits(rng, args.batch_size, args.n_vocab, args.zipf)
+
+    logits = tf.placeholder(tf.float32, [args.batch_size, args.n_vocab])
+    modes = {
+        'top_k': sample.top_k_logits(logits, k=args.top_k),
+        'top_p sort': sample.top_p_logits(logits, p=args.top_p, candidates=None),
+        'top_p': sample.top_p_logits(logits, p=args.top_p),
+        'top_k+top_p': sample.top_p_logits(sample.top_k_logits(logits, k=args.top_k), p=args.top_p, candidates=args.top_k),
+    }
+    with tf.Session() as sess:
+        kept = sess.run(modes['top_p sort'], feed_dict={logits: feed}) > -1e9
+        assert (kept == (sess.run(modes['top_p'], feed_dict={logits: feed}) > -1e9)).all()
+        print('nucleus: {:.0f} tokens on average'.format(kept.sum(axis=1).mean()))
+        for name, filtered in modes.items():
+            samples = tf.multinomial(filtered, num_samples=1, output_dtype=tf.int32)
+            sess.run(samples, feed_dict={logits: feed})
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                sess.run(samples, feed_dict={logits: feed})
+            elapsed = time.perf_counter() - start
+            print('{:12} {:8.3f} ms/token'.format(name, elapsed / args.steps * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmarks/speculative.py --model_name 355M --draft_model_name 124M [--draft_k 2 4 6]
+#
+# Times sample.sample_sequence against sample.speculative_sample_sequence
+# with a draft model, for each draft_k, and prints the acceptance rate and
+# the number of tokens each forward pass of the model produced.
+
+import argparse
+import json
+import os
+import time
+
+import tensorflow.compat.v1 as tf
+
+import encoder, model, sample
+
+parser = argparse.ArgumentParser(
+    description='Benchmark speculative sampling.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--model_name', metavar='MODEL', type=str, default='355M', help='Model to sample from')
+parser.add_argument('--draft_model_name', metavar='MODEL', type=str, default='124M', help='Model that drafts tokens')
+parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
+parser.add_argument('--draft_k', metavar='K', type=int, nargs='+', default=[2, 4, 6], help='Numbers of tokens drafted at a time')
+parser.add_argument('--prompt', type=str, default='Hello! How are you doing today?', help='Context to sample after')
+parser.add_argument('--length', metavar='N', type=int, default=40, help='Number of tokens to generate')
+parser.add_argument('--temperature', type=float, default=0.8, help='Sampling temperature')
+parser.add_argument('--top_k', type=int, default=40, help='K for top-k sampling')
+parser.add_argument('--top_p', type=float, default=0.9, help='P for top-p sampling')
+parser.add_argument('--runs', metavar='N', type=int, default=20, help='Number of samples to time')
+
+
+def load_hparams(model_dir):
+    hparams = model.default_hparams()
+    with open(os.path.join(model_dir, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    return hparams
+
+
+def main():
+    args = parser.parse_args()
+    tf.disable_eager_execution()
+    enc = encoder.get_encoder(args.model_name, models_dir=args.models_dir)
+    model_dir = os.path.join(args.models_dir, args.model_name)
+    draft_dir = os.path.join(args.models_dir, args.draft_model_name)
+    hparams, draft_hparams = load_hparams(model_dir), load_hparams(draft_dir)
+    sample_args = dict(length=args.length, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+
+    with tf.Session() as sess:
+        context = tf.placeholder(tf.int32, [1, None])
+        outputs = {'plain': (sample.sample_sequence(hparams=hparams, context=context, **sample_args), {})}
+        for k in args.draft_k:
+            outputs['draft_k=%d' % k] = sample.speculative_sample_sequence(
+                hparams=hparams, draft_hparams=draft_hparams, draft_k=k, context=context, **sample_args)
+        tf.train.Saver(var_list=tf.global_variables('model/')).restore(sess, tf.train.latest_checkpoint(model_dir))
+        tf.train.Saver(var_list={'model' + v.op.name[len('draft'):]: v for v in tf.global_variables('draft/')}).restore(
+            sess, tf.train.latest_checkpoint(draft_dir))
+
+        feed_dict = {context: [enc.encode(args.prompt)]}
+        baseline = None
+        for name, (output, stats) in outputs.items():
+            # The first runs of a while loop are slower
+            for _ in range(3):
+                sess.run(output, feed_dict=feed_dict)
+            tokens, elapsed = 0, 0.0
+            totals = dict.fromkeys(stats, 0)
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                out, counts = sess.run((output, stats), feed_dict=feed_dict)
+                elapsed += time.perf_counter() - start
+                tokens += out.shape[1] - len(feed_dict[context][0])
+                for stat, count in counts.items():
+                    totals[stat] += int(count)
+            ms_per_token = elapsed / tokens * 1000
+            baseline = baseline or ms_per_token
+            line = '{:12} {:8.2f} ms/token  {:5.2f}x'.format(name, ms_per_token, baseline / ms_per_token)
+            if totals:
+                line += '  acceptance {:.2f}  {:.2f} tokens/step'.format(
+                    totals['accepted'] / max(totals['drafted'], 1),
+                    (totals['steps'] + totals['kept']) / max(totals['steps'], 1))
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
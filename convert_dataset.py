@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./convert_dataset.py dataset/training_data_*.npz
+#  PYTHONPATH=src ./train.py --dataset dataset/training_data_124M.tokens
+#
+# Converts datasets pre-encoded to .npz (by encode.py) to token stores (see
+# load_dataset.save_tokens), written next to them as <name>.tokens. Training
+# memory-maps a token store instead of decompressing it into memory, so it
+# starts as fast for any size of dataset. The conversion itself decompresses
+# one chunk at a time, so it needs little memory too.
+
+import argparse
+import os
+import numpy as np
+
+from load_dataset import load_tokens, save_tokens, TOKENS_SUFFIX
+
+parser = argparse.ArgumentParser(
+    description='Convert pre-encoded .npz datasets to memory-mapped token stores.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('in_npz', metavar='IN.npz', type=str, nargs='+', help='Pre-encoded datasets')
+
+
+class NpzChunks(object):
+    """The chunks of an .npz, decompressed one at a time whenever it's iterated."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with np.load(self.path) as npz:
+            for item in npz.files:
+                yield npz[item]
+
+
+def main():
+    args = parser.parse_args()
+    for in_npz in args.in_npz:
+        out = os.path.splitext(in_npz)[0] + TOKENS_SUFFIX
+        save_tokens(out, NpzChunks(in_npz))
+        chunks = load_tokens(out)
+        print('Wrote {} ({} tokens in {} chunks)'.format(out, sum(len(chunk) for chunk in chunks), len(chunks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,15 @@
 # Usage:
 #  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/output.npz
 #  PYTHONPATH=src ./train --dataset /path/to/output.npz
+#
+# With an output path ending in .tokens, writes a token store instead (see
+# load_dataset.save_tokens), which train.py memory-maps rather than loads.
 
 import argparse
 import numpy as np
 
 import encoder
-from load_dataset import load_dataset
+from load_dataset import load_dataset, save_tokens, TOKENS_SUFFIX
 
 parser = argparse.ArgumentParser(
     description='Pre-encode text files into tokenized training set.',
@@ -16,16 +19,20 @@ parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', h
 parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate files with <|endoftext|> separator into chunks of this minimum size')
 parser.add_argument('--encoding', type=str, default='utf-8', help='Set the encoding for reading and writing files.')
+parser.add_argument('--workers', metavar='N', type=int, default=1, help='Encode documents in N processes (0 for one per core)')
 parser.add_argument('in_text', metavar='PATH', type=str, help='Input file, directory, or glob pattern (utf-8 text).')
-parser.add_argument('out_npz', metavar='OUT.npz', type=str, help='Output file path')
+parser.add_argument('out_npz', metavar='OUT.npz', type=str, help='Output file path, .npz or .tokens')
 
 def main():
     args = parser.parse_args()
     enc = encoder.get_encoder(args.model_name, models_dir=args.models_dir)
     print('Reading files')
-    chunks = load_dataset(enc, args.in_text, args.combine, encoding=args.encoding)
+    chunks = load_dataset(enc, args.in_text, args.combine, encoding=args.encoding, workers=args.workers or None)
     print('Writing', args.out_npz)
-    np.savez_compressed(args.out_npz, *chunks)
+    if args.out_npz.endswith(TOKENS_SUFFIX):
+        save_tokens(args.out_npz, chunks)
+    else:
+        np.savez_compressed(args.out_npz, *chunks)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./export_sampler.py --model_name 355M [--prefix "..."] [--xla]
+#
+# Writes models/<model_name>/sampler, a SavedModel of sample.sample_sequence
+# with the checkpoint's weights, and the prefix's keys/values and the sampling
+# options built in, for interact_model(backend='saved_model'). The options
+# are the ones of interact_model, which must be given the same ones.
+
+import contextlib
+import fire
+import json
+import os
+import shutil
+import time
+
+import tensorflow.compat.v1 as tf
+
+import encoder, model, sample
+import interactive_conditional_samples as ics
+
+def export_sampler(
+    model_name='oscar3',
+    seed=None,
+    batch_size=4,
+    length=40,
+    temperature=0.8,
+    top_k=40,
+    top_p=0.9,
+    top_p_within_top_k=False,
+    models_dir='models',
+    stop_at_newline=False,
+    sentence_min_length=None,
+    prefix=None,
+    precision='float32',
+    pad_multiple=16,
+    xla=False,
+):
+    """
+    Export the sampler of interact_model for backend='saved_model'
+    :batch_size=4 : Number of rows the sampler generates at once. Smaller
+     batches are filled up, larger ones split.
+    :pad_multiple=16 : Contexts are left-padded to a multiple of this many
+     tokens, so that the sampler sees few different shapes.
+    :xla=False : Compile the sampler with XLA, once for each shape it's run
+     with.
+    The other options are the ones of interact_model.
+    """
+    tf.disable_eager_execution()
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    model_dir = os.path.join(models_dir, model_name)
+    enc = encoder.get_encoder(model_name, models_dir)
+    hparams = model.default_hparams()
+    with open(os.path.join(model_dir, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    sample_args = ics.sample_sequence_args(enc, hparams, length=length, temperature=temperature, top_k=top_k,
+                                           top_p=top_p, top_p_within_top_k=top_p_within_top_k,
+                                           stop_at_newline=stop_at_newline, sentence_min_length=sentence_min_length)
+    prefix_tokens = enc.encode(prefix) if prefix else []
+    if len(prefix_tokens) + sample_args['length'] > hparams.n_ctx:
+        raise ValueError("Prefix is too long for window size: %s" % hparams.n_ctx)
+    dtype = model.PRECISIONS[precision]
+    checkpoint = tf.train.latest_checkpoint(model_dir)
+
+    export_dir = os.path.join(model_dir, ics.SAMPLER_DIR)
+    tmp_dir = export_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    start_time = time.perf_counter()
+    with tf.Session(graph=tf.Graph()) as sess:
+        if seed is not None:
+            tf.set_random_seed(seed)
+        context = tf.placeholder(tf.int32, [batch_size, None], name='context')
+        pad_lengths = tf.placeholder(tf.int32, [batch_size], name='pad_lengths')
+        past = None
+        if prefix_tokens:
+            prefix_cache = sample.PrefixCache(hparams, dtype=dtype)
+            tf.train.Saver(var_list=tf.global_variables('model/')).restore(sess, checkpoint)
+            past = tf.constant(prefix_cache.get(sess, prefix_tokens, checkpoint, batch_size))
+        with tf.xla.experimental.jit_scope() if xla else contextlib.nullcontext():
+            tokens, log_probs = sample.sample_sequence(
+                hparams=hparams,
+                context=context,
+                batch_size=batch_size,
+                past=past,
+                pad_lengths=pad_lengths,
+                preallocate=True,
+                return_log_probs=True,
+                dtype=dtype,
+                **sample_args,
+            )
+        if not prefix_tokens:
+            tf.train.Saver(var_list=tf.global_variables('model/')).restore(sess, checkpoint)
+        signature = tf.saved_model.predict_signature_def(
+            inputs={'context': context, 'pad_lengths': pad_lengths},
+            outputs={'tokens': tokens, 'log_probs': log_probs})
+        builder = tf.saved_model.Builder(tmp_dir)
+        builder.add_meta_graph_and_variables(
+            sess, [tf.saved_model.tag_constants.SERVING],
+            signature_def_map={tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature},
+            strip_default_attrs=True)
+        builder.save()
+    settings = ics.sampler_settings(checkpoint=checkpoint, seed=seed, prefix_tokens=prefix_tokens,
+                                    precision=precision, sample_args=sample_args)
+    settings.update(batch_size=batch_size, pad_multiple=pad_multiple, xla=xla)
+    with open(os.path.join(tmp_dir, ics.SAMPLER_SETTINGS), 'w') as f:
+        json.dump(settings, f)
+    shutil.rmtree(export_dir, ignore_errors=True)
+    os.replace(tmp_dir, export_dir)
+    print('Exported %s to %s in %.2f s' % (checkpoint, export_dir, time.perf_counter() - start_time))
+
+if __name__ == '__main__':
+    fire.Fire(export_sampler)
@@ -3,11 +3,12 @@ from __future__ import annotations
 # src.interactive_conditional_samples uses the local GPT-2 model (outdated, slower).
 # bot.kindroid uses the remote Kindroid AI (much better).
 # Only one of them should be imported, uncomment or comment the lines below as needed:
-# from src.interactive_conditional_samples import interact_model, STOP
-from bot.kindroid import interact_model, STOP
-
 from bot.text_process import post_process, pre_process
 from bot.filter import is_okay
+# from src.interactive_conditional_samples import interact_model, STOP
+# MODEL_KWARGS = {"candidates": 4, "post_process": post_process, "is_okay": is_okay}   # Pick among 4 replies the best one the filter lets through
+from bot.kindroid import interact_model, STOP
+MODEL_KWARGS = {}
 import socket, ssl, os, re, pickle
 import multiprocessing as mp
 import threading as td
@@ -65,7 +66,7 @@ class OscarBot():
         self.output_queue = mp.Queue()  # The responses the bot gave
         model_process = mp.Process(
             target=interact_model,
-            kwargs= {"input_queue": self.input_queue, "output_queue": self.output_queue},
+            kwargs= {"input_queue": self.input_queue, "output_queue": self.output_queue, **MODEL_KWARGS},
         )
         model_process.start()   # The AI model is being run in a separate process because it uses lots of CPU
 
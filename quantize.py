@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./quantize.py --model_name 355M held_out.txt
+#
+# Writes <checkpoint>.int8.npz, the int8 weights used by
+# interact_model(backend='int8'), and compares them with the float32 weights
+# on memory, generation speed and perplexity on the held-out text.
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import encoder
+import np_model
+import np_sample
+
+parser = argparse.ArgumentParser(
+    description='Quantize a checkpoint to int8 weights for NumPy inference.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--model_name', metavar='MODEL', type=str, default='oscar3', help='Pretrained model name')
+parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
+parser.add_argument('--checkpoint', metavar='PATH', type=str, default=None, help='Checkpoint to quantize (default: latest in the model directory)')
+parser.add_argument('--encoding', type=str, default='utf-8', help='Encoding of the held-out file')
+parser.add_argument('--eval_tokens', metavar='N', type=int, default=4096, help='Number of held-out tokens to compute the perplexity on')
+parser.add_argument('--window', metavar='N', type=int, default=256, help='Context length for the perplexity')
+parser.add_argument('--length', metavar='N', type=int, default=40, help='Number of tokens to generate when timing')
+parser.add_argument('held_out', metavar='PATH', type=str, help='Text file to compute the perplexity on')
+
+
+def nbytes(params):
+    return sum(value.nbytes for value in params.values())
+
+
+def perplexity(params, hparams, tokens, window):
+    total, count = 0.0, 0
+    for start in range(0, len(tokens) - 1, window):
+        chunk = tokens[start:start + window + 1]
+        logits = np_model.model(params, hparams, [chunk[:-1]])['logits'][0, :, :hparams.n_vocab]
+        logits = logits.astype(np.float64)
+        logits -= logits.max(axis=-1, keepdims=True)
+        log_probs = logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+        total -= log_probs[np.arange(len(chunk) - 1), chunk[1:]].sum()
+        count += len(chunk) - 1
+    return np.exp(total / count)
+
+
+def tokens_per_second(params, hparams, context, length):
+    start = time.perf_counter()
+    output = np_sample.sample_sequence(params=params, hparams=hparams, length=length, context=[context], top_k=1)
+    return (output.shape[1] - len(context)) / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    model_dir = os.path.join(args.models_dir, args.model_name)
+    enc = encoder.get_encoder(args.model_name, models_dir=args.models_dir)
+    hparams = np_model.default_hparams()
+    with open(os.path.join(model_dir, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    checkpoint = args.checkpoint or np_model.latest_checkpoint(model_dir)
+
+    params = np_model.load_params(checkpoint)
+    quantized = np_model.quantize_params(params)
+    print('Writing', checkpoint + '.int8.npz')
+    np_model.save_params(checkpoint + '.int8.npz', quantized)
+
+    with open(args.held_out, 'r', encoding=args.encoding) as fp:
+        tokens = enc.encode(fp.read())[:args.eval_tokens + 1]
+    window = min(args.window, hparams.n_ctx)
+    context = tokens[:min(20, len(tokens))]
+
+    results = []
+    for name, p in (('float32', params), ('int8', quantized)):
+        results.append((name, nbytes(p), tokens_per_second(p, hparams, context, args.length),
+                        perplexity(p, hparams, tokens, window)))
+    print('{:8} {:>10} {:>10} {:>10}'.format('', 'MB', 'tokens/s', 'ppl'))
+    for name, size, speed, ppl in results:
+        print('{:8} {:10.1f} {:10.2f} {:10.3f}'.format(name, size / 2**20, speed, ppl))
+    (_, size, speed, ppl), (_, q_size, q_speed, q_ppl) = results
+    print('Memory saved: {:.1f} MB ({:.0%})'.format((size - q_size) / 2**20, 1 - q_size / size))
+    print('Speed: {:.2f}x'.format(q_speed / speed))
+    print('Perplexity change: {:+.3f} ({:+.2%})'.format(q_ppl - ppl, q_ppl / ppl - 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,30 +7,43 @@ import time
 
 
 class AccumulatingOptimizer(object):
+    """Sums the gradients of several minibatches, then applies their mean with `opt`.
+
+    Run reset(), then compute_gradients' op once per minibatch, then apply_gradients' loss,
+    which is the mean loss of the minibatches."""
+
     def __init__(self, opt, var_list):
         self.opt = opt
         self.var_list = var_list
-        self.accum_vars = {tv : tf.Variable(tf.zeros_like(tv.initialized_value()), trainable=False)
-                           for tv in var_list}
-        self.total_loss = tf.Variable(tf.zeros(shape=[], dtype=tf.float32))
-        self.count_loss = tf.Variable(tf.zeros(shape=[], dtype=tf.float32))
+        # A list in var_list's order, since variables aren't hashable in TF 2
+        self.accum_vars = [tf.Variable(tf.zeros(tv.shape, dtype=tv.dtype), trainable=False)
+                           for tv in var_list]
+        self.total_loss = tf.Variable(tf.zeros(shape=[], dtype=tf.float32), trainable=False)
+        self.count_loss = tf.Variable(tf.zeros(shape=[], dtype=tf.float32), trainable=False)
 
     def reset(self):
-        updates = [tv.assign(tf.zeros_like(tv)) for tv in self.accum_vars.values()]
+        updates = [tv.assign(tf.zeros_like(tv)) for tv in self.accum_vars]
         updates.append(self.total_loss.assign(tf.zeros(shape=[], dtype=tf.float32)))
         updates.append(self.count_loss.assign(tf.zeros(shape=[], dtype=tf.float32)))
         with tf.control_dependencies(updates):
             return tf.no_op()
 
-    def compute_gradients(self, loss):
-        grads = self.opt.compute_gradients(loss, self.var_list)
-        updates = [self.accum_vars[v].assign_add(g) for (g,v) in grads]
+    def compute_gradients(self, loss, grads=None):
+        """`grads` are the gradients of `loss` for var_list, if they were already computed
+        (e.g. by memory_saving_gradients or tfremat)."""
+        if grads is None:
+            grads = self.opt.compute_gradients(loss, self.var_list)
+        else:
+            grads = list(zip(grads, self.var_list))
+        updates = [av.assign_add(g) for (g,v), av in zip(grads, self.accum_vars)]
         updates.append(self.total_loss.assign_add(loss))
         updates.append(self.count_loss.assign_add(1.0))
         with tf.control_dependencies(updates):
             return tf.no_op()
 
-    def apply_gradients(self):
-        grads = [(g,v) for (v,g) in self.accum_vars.items()]
-        with tf.control_dependencies([self.opt.apply_gradients(grads)]):
+    def apply_gradients(self, apply=None):
+        """`apply` is called with the mean gradients and variables instead of opt.apply_gradients,
+        e.g. to skip steps whose gradients aren't finite."""
+        grads = [(g / self.count_loss, v) for (v,g) in zip(self.var_list, self.accum_vars)]
+        with tf.control_dependencies([(apply or self.opt.apply_gradients)(grads)]):
             return self.total_loss / self.count_loss
@@ -1,9 +1,16 @@
 """Byte pair encoding utilities"""
 
+import codecs
+import gc
+import hashlib
+import marshal
 import os
 import json
+import re as stdlib_re
 import regex as re
-from functools import lru_cache
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+from heapq import heapify, heappop, heappush
 
 @lru_cache()
 def bytes_to_unicode():
@@ -39,22 +46,111 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+class TokenCache:
+    """Size-bounded LRU cache for BPE results, with hit/miss/eviction counters.
+
+    A capacity of None means unbounded, 0 disables caching.
+    """
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.capacity == 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if self.capacity is not None and len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+DEFAULT_CACHE_SIZE = 100000
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    # Everything encode/decode need from encoder.json and vocab.bpe, see `from_tables` and `get_encoder`.
+    # `decoder` and `bpe_ranks` are only rebuilt on first use when loading from tables.
+    TABLES = ('encoder', 'decoder_bytes', 'bpe_pair_ranks', 'bpe_rank_merges', 'bpe_symbols', 'bpe_symbol_tokens')
+
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=DEFAULT_CACHE_SIZE):
         self.encoder = encoder
         self.decoder = {v:k for k,v in self.encoder.items()}
-        self.errors = errors # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
+        self.decoder_bytes = [b''] * (max(self.decoder) + 1 if self.decoder else 0)
+        for token, text in self.decoder.items():
+            self.decoder_bytes[token] = bytes(self.byte_decoder[c] for c in text)
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.build_bpe_tables()
+        self.setup(errors, cache_size)
+
+    @classmethod
+    def from_tables(cls, tables, errors='replace', cache_size=DEFAULT_CACHE_SIZE):
+        """Rebuild an Encoder from the output of `tables()` without recomputing anything."""
+        self = cls.__new__(cls)
+        for name in cls.TABLES:
+            setattr(self, name, tables[name])
+        self.setup(errors, cache_size)
+        return self
+
+    def tables(self):
+        return {name: getattr(self, name) for name in self.TABLES}
+
+    @cached_property
+    def decoder(self):
+        return {v:k for k,v in self.encoder.items()}
+
+    @cached_property
+    def bpe_ranks(self):
+        symbols = self.bpe_symbols
+        return {(symbols[merge[0]], symbols[merge[1]]): rank
+                for rank, merge in enumerate(self.bpe_rank_merges) if merge is not None}
+
+    def setup(self, errors, cache_size):
+        self.errors = errors # how to handle errors in decoding
+        self.byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
+        self.cache = TokenCache(cache_size)
+        self.ids_cache = TokenCache(cache_size)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        # The same pattern restricted to ASCII input, for the stdlib `re` which is faster on plain
+        # character classes. \s is spelled out because `re`'s \s also matches \x1c-\x1f and `regex`'s doesn't.
+        self.ascii_pat = stdlib_re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[A-Za-z]+| ?[0-9]+| ?[^\t\n\x0b\x0c\r A-Za-z0-9]+|[\t\n\x0b\x0c\r ]+(?![^\t\n\x0b\x0c\r ])|[\t\n\x0b\x0c\r ]+""")
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
         word = tuple(token)
         pairs = get_pairs(word)
 
@@ -90,10 +186,108 @@ class Encoder:
             else:
                 pairs = get_pairs(word)
         word = ' '.join(word)
-        self.cache[token] = word
+        self.cache.put(token, word)
         return word
 
+    def build_bpe_tables(self):
+        """Build the integer tables used by `bpe_ids`.
+
+        Symbol ids 0-255 are the single bytes, so a word starts out as its utf-8 encoding.
+        Every merge result gets the next free id. `bpe_pair_ranks` maps a pair of symbol
+        ids to its rank, and `bpe_rank_merges[rank]` holds that pair and the merged symbol.
+        """
+        symbols = [self.byte_encoder[b] for b in range(2**8)]
+        symbol_ids = {s: i for i, s in enumerate(symbols)}
+
+        def symbol_id(s):
+            if s not in symbol_ids:
+                symbol_ids[s] = len(symbols)
+                symbols.append(s)
+            return symbol_ids[s]
+
+        self.bpe_pair_ranks = {}
+        self.bpe_rank_merges = [None] * (max(self.bpe_ranks.values()) + 1 if self.bpe_ranks else 0)
+        for (first, second), rank in self.bpe_ranks.items():
+            pair = (symbol_id(first), symbol_id(second))
+            self.bpe_pair_ranks[pair] = rank
+            self.bpe_rank_merges[rank] = pair + (symbol_id(first + second),)
+        self.bpe_symbols = symbols
+        self.bpe_symbol_tokens = [self.encoder.get(s) for s in symbols]
+
+    def bpe_ids(self, token):
+        """Integer version of `bpe`: takes a raw pre-tokenized string, returns a tuple of token ids.
+
+        The word is kept as a linked list of symbol ids, and the candidate pairs sit in a heap
+        ordered by (rank, position). All occurrences of the lowest rank are merged left to right
+        before anything else, like one pass of the loop in `bpe`, so the output is identical.
+        """
+        cached = self.ids_cache.get(token)
+        if cached is not None:
+            return cached
+        word = list(token.encode('utf-8'))
+        n = len(word)
+        if n > 1:
+            pair_ranks = self.bpe_pair_ranks
+            nxt = list(range(1, n + 1))
+            prv = list(range(-1, n - 1))
+            heap = []
+            for i in range(n - 1):
+                rank = pair_ranks.get((word[i], word[i+1]))
+                if rank is not None:
+                    heap.append((rank, i))
+            heapify(heap)
+            while heap:
+                rank = heap[0][0]
+                first, second, merged = self.bpe_rank_merges[rank]
+                positions = []
+                while heap and heap[0][0] == rank:
+                    positions.append(heappop(heap)[1])
+                for i in positions:
+                    j = nxt[i]
+                    # Stale entry: i was merged away or one of its symbols has grown since.
+                    if word[i] != first or j >= n or word[j] != second:
+                        continue
+                    word[i] = merged
+                    word[j] = -1
+                    k = nxt[j]
+                    nxt[i] = k
+                    if k < n:
+                        prv[k] = i
+                        new_rank = pair_ranks.get((merged, word[k]))
+                        if new_rank is not None:
+                            heappush(heap, (new_rank, i))
+                    p = prv[i]
+                    if p >= 0:
+                        new_rank = pair_ranks.get((word[p], merged))
+                        if new_rank is not None:
+                            heappush(heap, (new_rank, p))
+        symbol_tokens = self.bpe_symbol_tokens
+        ids = []
+        for symbol in word:
+            if symbol >= 0:
+                token_id = symbol_tokens[symbol]
+                if token_id is None:
+                    raise KeyError(self.bpe_symbols[symbol])
+                ids.append(token_id)
+        ids = tuple(ids)
+        self.ids_cache.put(token, ids)
+        return ids
+
+    def pretokenize(self, text):
+        """Split text into the words that BPE runs on, using the ASCII pattern when possible."""
+        if text.isascii():
+            return self.ascii_pat.findall(text)
+        return self.pat.findall(text)
+
     def encode(self, text):
+        bpe_tokens = []
+        bpe_ids = self.bpe_ids
+        for token in self.pretokenize(text):
+            bpe_tokens.extend(bpe_ids(token))
+        return bpe_tokens
+
+    def encode_reference(self, text):
+        """The original string-based encoder, kept to check and benchmark `bpe_ids` against."""
         bpe_tokens = []
         for token in re.findall(self.pat, text):
             token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
@@ -101,17 +295,127 @@ class Encoder:
         return bpe_tokens
 
     def decode(self, tokens):
-        text = ''.join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
-        return text
-
-def get_encoder(model_name, models_dir):
-    with open(os.path.join(models_dir, model_name, 'encoder.json'), 'r') as f:
-        encoder = json.load(f)
-    with open(os.path.join(models_dir, model_name, 'vocab.bpe'), 'r', encoding="utf-8") as f:
+        decoder_bytes = self.decoder_bytes
+        return b''.join([decoder_bytes[token] for token in tokens]).decode('utf-8', errors=self.errors)
+
+    def incremental_decoder(self):
+        return IncrementalDecoder(self)
+
+class IncrementalEncoder:
+    """Encodes text that arrives in pieces, e.g. blocks of a large file.
+
+    The pre-tokenizer's matches tile the text. A match can only change when more text
+    follows if the regex looked past the end of the text for it: that is the last match,
+    and any match starting in the last 3 characters (the contractions look ahead as far
+    as "'ll"). Those are held back and everything before them is encoded right away,
+    so `feed` + `flush` give the same tokens as `encode` on the whole text.
+    """
+    def __init__(self, enc):
+        self.enc = enc
+        self.pending = ''
+
+    def feed(self, text):
+        text = self.pending + text
+        words = self.enc.pretokenize(text)
+        start = len(text)
+        while words and (start == len(text) or start - len(words[-1]) >= len(text) - 3):
+            start -= len(words.pop())
+        self.pending = text[start:]
+        tokens = []
+        for word in words:
+            tokens.extend(self.enc.bpe_ids(word))
+        return tokens
+
+    def flush(self):
+        tokens = self.enc.encode(self.pending)
+        self.pending = ''
+        return tokens
+
+class IncrementalDecoder:
+    """Decodes tokens as they are generated.
+
+    A token can end in the middle of a utf-8 character, so bytes are buffered until the
+    character is complete. The concatenated output of `decode` + `flush` is the same as
+    `Encoder.decode` on all the tokens.
+    """
+    def __init__(self, enc):
+        self.decoder_bytes = enc.decoder_bytes
+        self.utf8 = codecs.getincrementaldecoder('utf-8')(errors=enc.errors)
+
+    def decode(self, tokens):
+        """Take one token id or a sequence of them, return the text that is complete so far."""
+        if isinstance(tokens, int) or not hasattr(tokens, '__iter__'):
+            tokens = [tokens]
+        decoder_bytes = self.decoder_bytes
+        return self.utf8.decode(b''.join([decoder_bytes[token] for token in tokens]))
+
+    def flush(self):
+        return self.utf8.decode(b'', final=True)
+
+# Bump when the layout of Encoder.TABLES changes, so old compiled files get rebuilt
+COMPILED_VERSION = 1
+COMPILED_NAME = 'encoder.compiled'
+
+def load_compiled(path, sources):
+    """Return the tables stored at `path`, or None if it is missing, stale or unreadable."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Millions of small objects, no cycles: don't let the collector walk them while loading
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            compiled = marshal.loads(data)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(compiled, dict) or compiled.get('version') != COMPILED_VERSION or compiled.get('sources') != sources:
+        return None
+    return compiled['tables']
+
+def save_compiled(path, sources, tables):
+    """Write the tables next to the model. Failing to write (e.g. read-only models dir) is not an error."""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(marshal.dumps({'version': COMPILED_VERSION, 'sources': sources, 'tables': tables}))
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_encoder(model_name, models_dir, cache_size=DEFAULT_CACHE_SIZE, compiled=True):
+    """Load the model's encoder.
+
+    With `compiled`, the parsed vocabulary and merge tables are kept in models/<name>/encoder.compiled,
+    together with the sha256 of encoder.json and vocab.bpe. The file is (re)built whenever it is
+    missing or the hashes don't match, and otherwise loaded instead of parsing the source files.
+    """
+    model_dir = os.path.join(models_dir, model_name)
+    with open(os.path.join(model_dir, 'encoder.json'), 'rb') as f:
+        encoder_data = f.read()
+    with open(os.path.join(model_dir, 'vocab.bpe'), 'rb') as f:
         bpe_data = f.read()
+    sources = {
+        'encoder.json': hashlib.sha256(encoder_data).hexdigest(),
+        'vocab.bpe': hashlib.sha256(bpe_data).hexdigest(),
+    }
+    compiled_path = os.path.join(model_dir, COMPILED_NAME)
+    if compiled:
+        tables = load_compiled(compiled_path, sources)
+        if tables is not None:
+            return Encoder.from_tables(tables, cache_size=cache_size)
+
+    encoder = json.loads(encoder_data)
+    bpe_data = bpe_data.decode('utf-8')
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split('\n')[1:-1]]
-    return Encoder(
+    enc = Encoder(
         encoder=encoder,
         bpe_merges=bpe_merges,
+        cache_size=cache_size,
     )
+    if compiled:
+        save_compiled(compiled_path, sources, enc.tables())
+    return enc
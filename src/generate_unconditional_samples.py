@@ -18,6 +18,7 @@ def sample_model(
     top_k=0,
     top_p=1,
     models_dir='models',
+    slide=None,
 ):
     """
     Run the sample_model
@@ -39,6 +40,9 @@ def sample_model(
      special setting meaning no restrictions. 40 generally is a good value.
      :models_dir : path to parent folder containing model subfolders
      (i.e. contains the <model_name> folder)
+    :slide=None : Number of tokens dropped from the model's window at a time
+     when a sample is longer than it, default: a quarter of the window. Each
+     slide runs the model over the whole window again.
     """
     models_dir = os.path.expanduser(os.path.expandvars(models_dir))
     enc = encoder.get_encoder(model_name, models_dir)
@@ -48,8 +52,10 @@ def sample_model(
 
     if length is None:
         length = hparams.n_ctx
-    elif length > hparams.n_ctx:
-        raise ValueError("Can't get samples longer than window size: %s" % hparams.n_ctx)
+    if length <= hparams.n_ctx:
+        slide = None
+    elif slide is None:
+        slide = hparams.n_ctx // 4
 
     with tf.Session(graph=tf.Graph()) as sess:
         np.random.seed(seed)
@@ -59,7 +65,8 @@ def sample_model(
             hparams=hparams, length=length,
             start_token=enc.encoder['<|endoftext|>'],
             batch_size=batch_size,
-            temperature=temperature, top_k=top_k, top_p=top_p
+            temperature=temperature, top_k=top_k, top_p=top_p,
+            slide=slide,
         )[:, 1:]
 
         saver = tf.train.Saver()
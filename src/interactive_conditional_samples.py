@@ -2,20 +2,24 @@
 
 from __future__ import annotations
 
+import contextlib
 import fire
+import functools
 import json
 import os
 import numpy as np
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
-import tensorflow._api.v2.compat.v1 as tf
 # Note: The PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION environment variable needs
 # to be set because the Google API module and Tensorflow require conflicting
 # versions of the Protobuf module. This variable makes Tensorflow to use a
 # different approach that does not use Protobuf.
+# Tensorflow itself is only imported by the 'tf' backend.
 
-import model, sample, encoder
+import encoder, np_model
 
 import multiprocessing as mp
+import queue
+import time
 
 """
 The model will be run in a separate process. It will use an input queue to get
@@ -33,16 +37,248 @@ queues should stop being processed, and the program should exit.
 STOP = "STOP"
 UserText:mp.Queue[tuple[str,str,str,str]]
 
+@contextlib.contextmanager
+def tf_backend(*, model_dir, hparams, seed, prefix_tokens, draft_model_dir=None, draft_hparams=None, draft_k=4,
+               precision='float32', **sample_args):
+    """Generate with the TensorFlow model (model.py and sample.py), in one of model.PRECISIONS.
+    `generate` returns the tokens and their log-probabilities.
+
+    With `draft_model_dir`, that model drafts `draft_k` tokens at a time for speculative sampling
+    (see sample.speculative_sample_sequence). Its counters are printed on exit."""
+    import tensorflow._api.v2.compat.v1 as tf
+    import model, sample
+
+    dtype = model.PRECISIONS[precision]
+    with tf.Session(graph=tf.Graph()) as sess:
+        # The number of rows changes with the number of messages in a batch
+        context = tf.placeholder(tf.int32, [None, None])
+        pad_lengths = tf.placeholder(tf.int32, [None])
+        past = draft_past = None
+        if prefix_tokens:
+            past = tf.placeholder(dtype, model.past_shape(hparams=hparams))
+            prefix_cache = sample.PrefixCache(hparams, dtype=dtype)
+            if draft_model_dir:
+                draft_past = tf.placeholder(dtype, model.past_shape(hparams=draft_hparams))
+                draft_prefix_cache = sample.PrefixCache(draft_hparams, scope='draft', dtype=dtype)
+        np.random.seed(seed)
+        tf.set_random_seed(seed)
+        if draft_model_dir:
+            output, log_probs, stats = sample.speculative_sample_sequence(
+                hparams=hparams,
+                draft_hparams=draft_hparams,
+                draft_k=draft_k,
+                context=context,
+                past=past,
+                draft_past=draft_past,
+                pad_lengths=pad_lengths,
+                return_log_probs=True,
+                dtype=dtype,
+                **sample_args,
+            )
+        else:
+            output, log_probs = sample.sample_sequence(
+                hparams=hparams,
+                context=context,
+                past=past,
+                pad_lengths=pad_lengths,
+                return_log_probs=True,
+                dtype=dtype,
+                **sample_args,
+            )
+            stats = {}
+
+        saver = tf.train.Saver(var_list=tf.global_variables('model/'))
+        ckpt = tf.train.latest_checkpoint(model_dir)
+        saver.restore(sess, ckpt)
+        if draft_model_dir:
+            # The draft checkpoint has its variables under 'model' too
+            draft_saver = tf.train.Saver(var_list={
+                'model' + v.op.name[len('draft'):]: v for v in tf.global_variables('draft/')})
+            draft_ckpt = tf.train.latest_checkpoint(draft_model_dir)
+            draft_saver.restore(sess, draft_ckpt)
+        if prefix_tokens:
+            prefix_cache.get(sess, prefix_tokens, ckpt)
+            if draft_model_dir:
+                draft_prefix_cache.get(sess, prefix_tokens, draft_ckpt)
+
+        totals = dict.fromkeys(stats, 0)
+
+        def generate(rows, lengths):
+            feed_dict = {context: rows, pad_lengths: lengths}
+            if prefix_tokens:
+                feed_dict[past] = prefix_cache.get(sess, prefix_tokens, ckpt, len(rows))
+                if draft_model_dir:
+                    feed_dict[draft_past] = draft_prefix_cache.get(sess, prefix_tokens, draft_ckpt, len(rows))
+            out, scores, counts = sess.run((output, log_probs, stats), feed_dict=feed_dict)
+            for name, count in counts.items():
+                totals[name] += int(count)
+            return out, scores
+
+        yield generate
+
+        if draft_model_dir:
+            print("Speculative sampling:", dict(
+                totals,
+                acceptance_rate=totals['accepted'] / max(totals['drafted'], 1),
+                tokens_per_step=(totals['steps'] + totals['kept']) / max(totals['steps'], 1),
+            ))
+
+@contextlib.contextmanager
+def numpy_backend(*, model_dir, hparams, seed, prefix_tokens, quantized=False, draft_model_dir=None,
+                  draft_hparams=None, draft_k=None, precision='float32', **sample_args):
+    """Generate with the NumPy port of the model (np_model.py and np_sample.py), like tf_backend."""
+    import np_sample
+
+    if draft_model_dir:
+        raise ValueError("Speculative sampling needs backend='tf'")
+    if precision != 'float32':
+        raise ValueError("precision=%r needs backend='tf'" % precision)
+
+    params = np_model.load_params(np_model.latest_checkpoint(model_dir), quantized=quantized)
+    rng = np.random.RandomState(seed)
+    prefix_past = None
+    if prefix_tokens:
+        prefix_past = np_model.model(params, hparams, [prefix_tokens])['present']
+
+    def generate(rows, lengths):
+        past = None if prefix_past is None else np.repeat(prefix_past, len(rows), axis=0)
+        return np_sample.sample_sequence(
+            params=params, hparams=hparams,
+            context=rows,
+            past=past,
+            pad_lengths=lengths,
+            rng=rng,
+            return_log_probs=True,
+            **sample_args,
+        )
+
+    yield generate
+
+# Where export_sampler.py writes the sampler, in the model's directory
+SAMPLER_DIR = 'sampler'
+SAMPLER_SETTINGS = 'settings.json'
+
+def sampler_settings(*, checkpoint, seed, prefix_tokens, precision, sample_args):
+    """What an exported sampler was made with, as saved in its SAMPLER_SETTINGS."""
+    return json.loads(json.dumps(dict(
+        checkpoint=os.path.basename(checkpoint),
+        seed=seed,
+        prefix_tokens=list(prefix_tokens),
+        precision=precision,
+        sample_args=sample_args,
+    )))
+
+@contextlib.contextmanager
+def saved_model_backend(*, model_dir, hparams, seed, prefix_tokens, draft_model_dir=None, draft_hparams=None,
+                        draft_k=None, precision='float32', **sample_args):
+    """Generate with the SavedModel export_sampler.py wrote to <model_dir>/sampler, like tf_backend.
+
+    Its checkpoint, seed, prefix, precision and sampling options are part of the export, and
+    must be the ones asked for."""
+    import tensorflow._api.v2.compat.v1 as tf
+
+    if draft_model_dir:
+        raise ValueError("Speculative sampling needs backend='tf'")
+    export_dir = os.path.join(model_dir, SAMPLER_DIR)
+    with open(os.path.join(export_dir, SAMPLER_SETTINGS)) as f:
+        settings = json.load(f)
+    expected = sampler_settings(checkpoint=np_model.latest_checkpoint(model_dir), seed=seed,
+                                prefix_tokens=prefix_tokens, precision=precision, sample_args=sample_args)
+    changed = [name for name, value in expected.items() if settings[name] != value]
+    if changed:
+        raise ValueError("%s was exported with a different %s, run export_sampler.py again" % (
+            export_dir, ', '.join(changed)))
+    batch_size, pad_multiple = settings['batch_size'], settings['pad_multiple']
+    pad_token = sample_args['pad_token']
+
+    with tf.Session(graph=tf.Graph()) as sess:
+        signature = tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], export_dir).signature_def[
+            tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        context, pad_lengths = (sess.graph.get_tensor_by_name(signature.inputs[name].name)
+                                for name in ('context', 'pad_lengths'))
+        output, log_probs = (sess.graph.get_tensor_by_name(signature.outputs[name].name)
+                             for name in ('tokens', 'log_probs'))
+
+        def generate(rows, lengths):
+            # The sampler has a fixed batch size, and the contexts are padded some more to a
+            # multiple of pad_multiple, so that there are few shapes to compile for
+            extra = -len(rows[0]) % pad_multiple
+            rows = [[pad_token] * extra + list(row) for row in rows]
+            lengths = [length + extra for length in lengths]
+            outs, scores = [], []
+            for start in range(0, len(rows), batch_size):
+                n = min(batch_size, len(rows) - start)
+                filler = batch_size - n
+                out, score = sess.run((output, log_probs), feed_dict={
+                    context: rows[start:start + n] + rows[:1] * filler,
+                    pad_lengths: lengths[start:start + n] + lengths[:1] * filler,
+                })
+                outs.append(out[:n, extra:])
+                scores.append(score[:n])
+            # Rows that stopped early are shorter
+            width = max(out.shape[1] for out in outs)
+            outs = [np.pad(out, [[0, 0], [0, width - out.shape[1]]], constant_values=pad_token) for out in outs]
+            return np.concatenate(outs), np.concatenate(scores)
+
+        yield generate
+
+BACKENDS = {
+    'tf': tf_backend,
+    'numpy': numpy_backend,
+    'int8': functools.partial(numpy_backend, quantized=True),
+    'saved_model': saved_model_backend,
+}
+
+def sample_sequence_args(enc, hparams, *, length, temperature, top_k, top_p, top_p_within_top_k, stop_at_newline,
+                         sentence_min_length):
+    """The arguments of sample_sequence for interact_model's sampling options."""
+    if length is None:
+        length = hparams.n_ctx // 2
+    elif length > hparams.n_ctx:
+        raise ValueError("Can't get samples longer than window size: %s" % hparams.n_ctx)
+
+    end_token = enc.encoder['<|endoftext|>']
+    soft_stop_tokens = []
+    if sentence_min_length is not None:
+        soft_stop_tokens += [token for token, text in enumerate(enc.decoder_bytes) if text.endswith((b'.', b'!', b'?'))]
+    if stop_at_newline:
+        # A soft stop too: a reply that starts with a line break goes on to its first line
+        soft_stop_tokens += [token for token, text in enumerate(enc.decoder_bytes) if b'\n' in text]
+    return dict(
+        length=length,
+        temperature=temperature, top_k=top_k, top_p=top_p, top_p_within_top_k=top_p_within_top_k,
+        stop_tokens=[end_token],
+        soft_stop_tokens=soft_stop_tokens or None,
+        min_length=sentence_min_length if sentence_min_length is not None else 2,
+        pad_token=end_token,
+    )
+
 def interact_model(
     model_name='oscar3',
     seed=None,
     nsamples=1,
+    candidates=1,
     batch_size=1,
+    max_batch=4,
+    batch_wait=0.05,
     length=40,
     temperature=0.8,
     top_k=40,
     top_p=0.9,
+    top_p_within_top_k=False,
     models_dir='models',
+    cache_size=encoder.DEFAULT_CACHE_SIZE,
+    stop_at_newline=False,
+    sentence_min_length=None,
+    prefix=None,
+    backend='tf',
+    precision='float32',
+    draft_model_name=None,
+    draft_k=4,
+    post_process=None,
+    is_okay=None,
+    min_reply_length=1,
+    warmup=True,
     input_queue:UserText=None,
     output_queue:UserText=None,
 ):
@@ -51,8 +287,18 @@ def interact_model(
     :model_name=124M : String, which model to use
     :seed=None : Integer seed for random number generators, fix seed to reproduce
      results
-    :nsamples=1 : Number of samples to return total
-    :batch_size=1 : Number of batches (only affects speed/memory).  Must divide nsamples.
+    :nsamples=1 : Number of samples to return for each message
+    :candidates=1 : Number of candidates generated for each sample, in the same
+     batch. The first good one is returned: long enough (see min_reply_length)
+     and accepted by is_okay. If none is, the one with the highest
+     log-probability per token among the long enough ones.
+    :batch_size=1 : Number of samples of a message generated together (only
+     affects speed/memory). Must divide nsamples.
+    :max_batch=4 : Maximum number of messages answered together. Messages that
+     arrive while the model is busy are answered in one batch, left-padded to a
+     common length. 1 answers them one at a time.
+    :batch_wait=0.05 : Seconds to wait for more messages after the first one
+     before generating a batch that isn't full
     :length=None : Number of tokens in generated text, if None (default), is
      determined by model hyperparameters
     :temperature=1 : Float value controlling randomness in boltzmann
@@ -63,54 +309,158 @@ def interact_model(
      considered for each step (token), resulting in deterministic completions,
      while 40 means 40 words are considered at each step. 0 (default) is a
      special setting meaning no restrictions. 40 generally is a good value.
+    :top_p=0.9 : Float value. Only the most likely tokens whose probabilities add
+     up to top_p are considered, and top_k is ignored. 0 means no restrictions.
+    :top_p_within_top_k=False : Apply both top_k and top_p: the top_p tokens
+     are taken among the top_k ones.
      :models_dir : path to parent folder containing model subfolders
      (i.e. contains the <model_name> folder)
+     :cache_size : maximum number of words kept in the encoder's BPE cache
+     (None for unbounded). Its hit/miss/eviction counters are printed on exit.
+     Generating always stops at <|endoftext|>.
+     :stop_at_newline=False : Also stop at the first line break once
+     sentence_min_length tokens were generated (two if it's None), so that a
+     reply doesn't end before it starts.
+     :sentence_min_length=None : Stop at the first sentence-final punctuation
+     (. ! ?) once this many tokens were generated. None to disable.
+     :prefix=None : Text put before every message, e.g. a persona. Its keys/values
+     are computed once per checkpoint, so only the message goes through the model.
+     :backend='tf' : 'tf' runs the TensorFlow graph. 'numpy' runs the same model in
+     NumPy, which starts faster and uses less memory; it converts the checkpoint to
+     <checkpoint>.npz the first time (see np_model.load_params). 'int8' is the
+     'numpy' backend with int8 weights, which need a quarter of the memory (see
+     quantize.py).
+     :precision='float32' : 'bfloat16' or 'float16' run the matmuls, activations
+     and key/value cache of the 'tf' backend in that dtype (see model.model).
+     bfloat16 is faster on CPUs with AVX512_BF16 or AMX.
+     :draft_model_name=None : A smaller model with the same vocabulary (e.g. 124M
+     for 355M) that drafts draft_k tokens at a time for the model to check in
+     one pass. The answers are sampled from the same distribution, only faster
+     when the draft is often right. Its acceptance rate is printed on exit.
+     Needs backend='tf'.
+     :draft_k=4 : Number of tokens drafted at a time.
+     :post_process=None : Function applied to a candidate's text before is_okay
+     (e.g. bot.text_process.post_process). The text returned is not processed.
+     :is_okay=None : Function telling whether a processed candidate can be sent
+     (e.g. bot.filter.is_okay). How many candidates it rejected is printed on exit.
+     :min_reply_length=1 : Candidates with fewer characters than this after
+     post_process, not counting surrounding whitespace, are rejected too.
+     :warmup=True : Generate once before listening, so that the first reply
+     doesn't wait for TensorFlow to set up its kernels (or for XLA to compile).
+     The startup time and the first reply's latency are printed.
     """
+    start_time = time.perf_counter()
     models_dir = os.path.expanduser(os.path.expandvars(models_dir))
     if batch_size is None:
         batch_size = 1
-    assert nsamples % batch_size == 0
+    if nsamples % batch_size != 0:
+        raise ValueError("batch_size=%s must divide nsamples=%s" % (batch_size, nsamples))
+    # Each sample of a run has its candidates next to each other
+    rows_per_message = batch_size * candidates
 
-    enc = encoder.get_encoder(model_name, models_dir)
-    hparams = model.default_hparams()
+    enc = encoder.get_encoder(model_name, models_dir, cache_size=cache_size)
+    hparams = np_model.default_hparams()
     with open(os.path.join(models_dir, model_name, 'hparams.json')) as f:
         hparams.override_from_dict(json.load(f))
 
-    if length is None:
-        length = hparams.n_ctx // 2
-    elif length > hparams.n_ctx:
-        raise ValueError("Can't get samples longer than window size: %s" % hparams.n_ctx)
+    args = sample_sequence_args(enc, hparams, length=length, temperature=temperature, top_k=top_k, top_p=top_p,
+                                top_p_within_top_k=top_p_within_top_k, stop_at_newline=stop_at_newline,
+                                sentence_min_length=sentence_min_length)
+    length, end_token = args['length'], args['pad_token']
 
-    with tf.Session(graph=tf.Graph()) as sess:
-        context = tf.placeholder(tf.int32, [batch_size, None])
-        np.random.seed(seed)
-        tf.set_random_seed(seed)
-        output = sample.sample_sequence(
-            hparams=hparams, length=length,
-            context=context,
-            batch_size=batch_size,
-            temperature=temperature, top_k=top_k, top_p=top_p
-        )
+    draft_hparams = None
+    if draft_model_name:
+        draft_hparams = np_model.default_hparams()
+        with open(os.path.join(models_dir, draft_model_name, 'hparams.json')) as f:
+            draft_hparams.override_from_dict(json.load(f))
 
-        saver = tf.train.Saver()
-        ckpt = tf.train.latest_checkpoint(os.path.join(models_dir, model_name))
-        saver.restore(sess, ckpt)
+    prefix_tokens = enc.encode(prefix) if prefix else []
+    # Speculative sampling can run up to draft_k tokens past the length
+    message_length = hparams.n_ctx - len(prefix_tokens) - length - (draft_k if draft_model_name else 0)
+    if message_length < 1:
+        raise ValueError("Prefix is too long for window size: %s" % hparams.n_ctx)
 
-        print("-" * 40 + "\nBot is ready! Listening for messages.\n" + "-" * 40)
-        while True:
-            next_item = input_queue.get()
-            if next_item == STOP:
-                output_queue.put(STOP, block=False)
-                break
-            platform, raw_text, response_id, username = next_item
-            context_tokens = enc.encode(raw_text)
+    with BACKENDS[backend](
+        model_dir=os.path.join(models_dir, model_name),
+        hparams=hparams,
+        seed=seed,
+        prefix_tokens=prefix_tokens,
+        draft_model_dir=os.path.join(models_dir, draft_model_name) if draft_model_name else None,
+        draft_hparams=draft_hparams,
+        draft_k=draft_k,
+        precision=precision,
+        **args,
+    ) as generate:
+        filter_stats = {'candidates': 0, 'rejected': 0, 'all_rejected': 0}
+
+        def pick_candidate(rows, log_probs):
+            texts = [enc.decode(row[row != end_token]) for row in rows]
+            processed = [post_process(text) if post_process else text for text in texts]
+            # Empty and very short replies come first in any per-token ranking, but are no reply
+            long_enough = np.array([len(text.strip()) >= min_reply_length for text in processed])
+            okay = long_enough.copy()
+            if is_okay is not None:
+                okay &= np.array([is_okay(text) for text in processed], dtype=bool)
+            filter_stats['candidates'] += len(texts)
+            filter_stats['rejected'] += int((~okay).sum())
+            filter_stats['all_rejected'] += int(not okay.any())
+            if okay.any():
+                # The candidates are independent samples, so the first good one is as good as any
+                return texts[int(np.argmax(okay))]
+            # Log-probability per token, so that longer replies aren't penalized
+            scores = np.asarray(log_probs) / np.maximum((rows != end_token).sum(axis=1), 1)
+            if long_enough.any():
+                scores = np.where(long_enough, scores, -np.inf)
+            return texts[int(np.argmax(scores))]
+
+        def generate_batch(items):
+            # Longer messages are cut to their end, the part the reply follows
+            tokens = [enc.encode(raw_text)[-message_length:] for _, raw_text, _, _ in items]
+            max_length = max(len(t) for t in tokens)
+            rows = [t for t in tokens for _ in range(rows_per_message)]
             for _ in range(nsamples // batch_size):
-                out = sess.run(output, feed_dict={
-                    context: [context_tokens for _ in range(batch_size)]
-                })[:, len(context_tokens):]
-                for i in range(batch_size):
-                    text = enc.decode(out[i])
+                out, log_probs = generate(
+                    [[end_token] * (max_length - len(t)) + t for t in rows],
+                    [max_length - len(t) for t in rows],
+                )
+                out = out[:, max_length:]
+                for i in range(0, len(rows), candidates):
+                    platform, _, response_id, username = items[i // rows_per_message]
+                    text = pick_candidate(out[i:i + candidates], log_probs[i:i + candidates])
                     output_queue.put((platform, text, response_id, username), block=False)
 
+        if warmup:
+            generate([[end_token]], [0])
+        print("Startup: %.2f s" % (time.perf_counter() - start_time))
+        print("-" * 40 + "\nBot is ready! Listening for messages.\n" + "-" * 40)
+        first_reply = True
+        stopping = False
+        while not stopping:
+            # Wait for a message, then collect whatever else arrives shortly after it
+            items = [input_queue.get()]
+            received = time.perf_counter()
+            deadline = time.monotonic() + batch_wait
+            while items[-1] != STOP and len(items) < max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(input_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if items[-1] == STOP:
+                items.pop()
+                stopping = True
+            if items:
+                generate_batch(items)
+                if first_reply:
+                    print("First reply: %.2f s" % (time.perf_counter() - received))
+                    first_reply = False
+
+        print("Encoder cache:", enc.ids_cache.stats())
+        if candidates > 1 or is_okay is not None:
+            print("Candidate filter:", filter_stats)
+        output_queue.put(STOP, block=False)
+
 if __name__ == '__main__':
     fire.Fire(interact_model)
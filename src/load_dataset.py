@@ -1,11 +1,16 @@
+import array
+import contextlib
 import glob
+import multiprocessing as mp
 import numpy as np
 import os
 import tensorflow.compat.v1 as tf
 import tqdm
 
+import encoder
 
-def load_dataset(enc, path, combine, encoding=None):
+
+def find_paths(path):
     paths = []
     if os.path.isfile(path):
         # Simple file
@@ -18,66 +23,199 @@ def load_dataset(enc, path, combine, encoding=None):
     else:
         # Assume glob
         paths = glob.glob(path)
+    return paths
+
+
+# A token store is a flat .npy array of tokens at <name>.tokens and the offsets of its
+# chunks at <name>.tokens.index, see save_tokens
+TOKENS_SUFFIX = '.tokens'
+INDEX_SUFFIX = '.index'
+
+
+def save_tokens(path, chunks):
+    """Write `chunks` as a token store at `path`: all of their tokens in one flat array (uint16
+    if they fit), and the offset where each chunk starts, plus the total, at path + INDEX_SUFFIX.
+
+    `chunks` is iterated twice, for the sizes and then for the tokens, and only one chunk is
+    needed at a time: it can load each chunk when it gets to it (see convert_dataset.py)."""
+    sizes = []
+    dtype = np.uint16
+    for chunk in chunks:
+        sizes.append(len(chunk))
+        if len(chunk) and chunk.max() >= 2**16:
+            dtype = np.int32
+    boundaries = np.cumsum([0] + sizes, dtype=np.int64)
+    tokens = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(int(boundaries[-1]),))
+    for chunk, start in zip(chunks, boundaries):
+        tokens[start:start + len(chunk)] = chunk
+    tokens.flush()
+    del tokens
+    with open(path + INDEX_SUFFIX, 'wb') as fp:
+        np.save(fp, boundaries)
+
+
+def load_tokens(path):
+    """The chunks of the token store at `path`, as views of the memory-mapped tokens.
+
+    Nothing is read before it's used, so loading takes the same time and memory for any size."""
+    tokens = np.load(path, mmap_mode='r')
+    with open(path + INDEX_SUFFIX, 'rb') as fp:
+        boundaries = np.load(fp)
+    return [tokens[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])]
 
-    token_chunks = []
-    raw_text = ''
-    for path in tqdm.tqdm(paths):
-        if path.endswith('.npz'):
+
+def token_dtype(enc):
+    """Smallest integer type that holds every token id of the encoder."""
+    return np.uint16 if len(enc.encoder) <= 2**16 else np.int32
+
+
+def count_chars(path, encoding=None, block_size=2**20):
+    """Number of characters in the text file at `path`, read in blocks."""
+    with open(path, 'r', encoding=encoding) as fp:
+        return sum(len(block) for block in iter(lambda: fp.read(block_size), ''))
+
+
+def list_sources(paths, combine, encoding=None, block_size=2**20):
+    """What each chunk of load_dataset comes from, in the order the chunks are made.
+
+    Token stores and .npz files are listed by path. Text files are grouped into
+    chunks of at least `combine` characters: each group is a tuple of the paths
+    and whether they are all followed by <|endoftext|>, which is the case only
+    for a last group that stayed short (the others have it between files)."""
+    sources = []
+    text_paths = []
+    for path in paths:
+        if path.endswith(TOKENS_SUFFIX + INDEX_SUFFIX):
+            # Read along with its token store
+            continue
+        elif path.endswith(TOKENS_SUFFIX) or path.endswith('.npz'):
             # Pre-encoded
-            with np.load(path) as npz:
-                for item in npz.files:
-                    token_chunks.append(npz[item])
+            sources.append(path)
         else:
             # Plain text
-            with open(path, 'r', encoding=encoding) as fp:
-                raw_text += fp.read()
-            if len(raw_text) >= combine:
-                tokens = np.stack(enc.encode(raw_text))
-                token_chunks.append(tokens)
-                raw_text = ''
+            if not text_paths:
+                chunk_size = 0
+            text_paths.append(path)
+            chunk_size += count_chars(path, encoding=encoding, block_size=block_size)
+            if chunk_size >= combine:
+                sources.append((text_paths, False))
+                text_paths = []
             else:
-                raw_text += '<|endoftext|>'
-    if raw_text:
-        tokens = np.stack(enc.encode(raw_text))
-        token_chunks.append(tokens)
-    return token_chunks
-
-
-def binary_search(f, lo, hi):
-    if f(lo) or not f(hi):
-        return None
-    while hi > lo + 1:
-        mid = (lo + hi) // 2
-        if f(mid):
-            hi = mid
+                chunk_size += len('<|endoftext|>')
+    if text_paths:
+        sources.append((text_paths, True))
+    return sources
+
+
+def encode_text(enc, paths, terminated, encoding=None, block_size=2**20):
+    """The tokens of the text files at `paths` joined with <|endoftext|> (and followed by it if
+    `terminated`). The text is never held whole: blocks go through an IncrementalEncoder and the
+    tokens into a typed array, so memory is bounded by the tokens rather than by the text."""
+    stream = encoder.IncrementalEncoder(enc)
+    tokens = array.array('H' if token_dtype(enc) == np.uint16 else 'i')
+    for i, path in enumerate(paths):
+        if i:
+            tokens.extend(stream.feed('<|endoftext|>'))
+        with open(path, 'r', encoding=encoding) as fp:
+            for block in iter(lambda: fp.read(block_size), ''):
+                tokens.extend(stream.feed(block))
+    if terminated:
+        tokens.extend(stream.feed('<|endoftext|>'))
+    tokens.extend(stream.flush())
+    return np.frombuffer(tokens, dtype=token_dtype(enc))
+
+
+# Each process of iter_chunks' pool gets the encoder once, from the pool initializer
+_worker_encoder = None
+
+def _init_worker(enc):
+    global _worker_encoder
+    _worker_encoder = enc
+
+def _encode_worker_text(args):
+    return encode_text(_worker_encoder, *args)
+
+
+def iter_chunks(enc, paths, combine, encoding=None, block_size=2**20, workers=1):
+    """Yield token chunks one at a time, reading text files in blocks.
+
+    Text files are joined with <|endoftext|> into chunks of at least `combine`
+    characters, as in load_dataset, see list_sources and encode_text. With
+    `workers` other than 1 (None for every core), the text chunks are encoded
+    in that many processes, which read their files themselves; the chunks are
+    the same whatever the number of workers."""
+    sources = list_sources(paths, combine, encoding=encoding, block_size=block_size)
+    texts = [source + (encoding, block_size) for source in sources if isinstance(source, tuple)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(texts))
+    with contextlib.ExitStack() as stack:
+        if workers <= 1:
+            encoded = (encode_text(enc, *args) for args in texts)
         else:
-            lo = mid
-    return hi
+            pool = stack.enter_context(mp.Pool(workers, initializer=_init_worker, initargs=(enc,)))
+            encoded = pool.imap(_encode_worker_text, texts)
+        for source in tqdm.tqdm(sources):
+            if isinstance(source, tuple):
+                yield next(encoded)
+            elif source.endswith(TOKENS_SUFFIX):
+                yield from load_tokens(source)
+            else:
+                with np.load(source) as npz:
+                    for item in npz.files:
+                        yield npz[item]
+
+
+def load_dataset(enc, path, combine, encoding=None, workers=1):
+    return list(iter_chunks(enc, find_paths(path), combine, encoding=encoding, workers=workers))
 
 
 class Sampler(object):
     """Fairly samples a slice from a set of variable sized chunks.
 
     'Fairly' means that the distribution is the same as sampling from one concatenated chunk,
-    but without crossing chunk boundaries."""
+    but without crossing chunk boundaries: every slice that fits in a chunk is equally likely."""
 
     def __init__(self, chunks, seed=None):
         self.chunks = chunks
-        self.total_size = sum(chunk.shape[0] for chunk in chunks)
-        self.boundaries = [0]
-        for i in range(len(chunks)):
-            self.boundaries.append(self.boundaries[-1] + chunks[i].shape[0])
+        self.sizes = np.array([chunk.shape[0] for chunk in chunks], dtype=np.int64)
+        self.boundaries = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.total_size = int(self.boundaries[-1])
         self.rs = np.random.RandomState(seed=seed)
+        # For each length, the number of slices that fit in the chunks up to each one
+        self.slice_counts = {}
+
+    def draw(self, count, length):
+        """Chunk indices and offsets within them of `count` random slices of `length` tokens."""
+        if length not in self.slice_counts:
+            self.slice_counts[length] = np.cumsum(np.maximum(self.sizes - length + 1, 0))
+        cumulated = self.slice_counts[length]
+        assert cumulated[-1] > 0, "Dataset files are too small to sample {} tokens at a time".format(length)
+        # Number every slice that fits in a chunk, chunk after chunk, and pick among them
+        picks = self.rs.randint(0, cumulated[-1], size=count)
+        indices = np.searchsorted(cumulated, picks, side='right')
+        first = np.concatenate([[0], cumulated[:-1]])
+        return indices, picks - first[indices]
 
     def sample(self, length):
-        assert length < self.total_size // len(
-            self.chunks
-        ), "Dataset files are too small to sample {} tokens at a time".format(
-            length)
+        [index], [offset] = self.draw(1, length)
+        return self.chunks[index][offset:offset + length]
+
+    def sample_batch(self, batch_size, length):
+        """A [batch_size, length] array of random slices."""
+        indices, offsets = self.draw(batch_size, length)
+        return np.stack([self.chunks[index][offset:offset + length] for index, offset in zip(indices, offsets)])
+
+
+def sample_batches(sampler, batch_size, length, prefetch=4):
+    """A tf.data.Dataset of endless [batch_size, length] int32 batches from `sampler`.
+
+    The batches are sampled in a background thread, up to `prefetch` batches ahead of the
+    training step that consumes them. The generator runs on the session's inter-op threads,
+    and can deadlock with a step waiting for it if there's only one."""
+    def batches():
         while True:
-            index = self.rs.randint(0, self.total_size - length - 1)
-            i = binary_search(lambda j: self.boundaries[j] > index, 0,
-                              len(self.boundaries) - 1) - 1
-            if self.boundaries[i + 1] > index + length:
-                within_chunk = index - self.boundaries[i]
-                return self.chunks[i][within_chunk:within_chunk + length]
+            yield sampler.sample_batch(batch_size, length).astype(np.int32)
+
+    dataset = tf.data.Dataset.from_generator(batches, output_types=tf.int32, output_shapes=[batch_size, length])
+    return dataset.prefetch(prefetch)
@@ -11,6 +11,13 @@ class HParams(object):
             setattr(self, k, v)
 
 
+# Names of the dtypes model can run in, for command line options
+PRECISIONS = {
+    'float32': tf.float32,
+    'bfloat16': tf.bfloat16,
+    'float16': tf.float16,
+}
+
 def default_hparams():
     return HParams(
         n_vocab=0,
@@ -26,17 +33,15 @@ def shape_list(x):
     dynamic = tf.shape(x)
     return [dynamic[i] if s is None else s for i, s in enumerate(static)]
 
-def softmax(x, axis=-1):
-    x = x - tf.reduce_max(x, axis=axis, keepdims=True)
-    ex = tf.exp(x)
-    return ex / tf.reduce_sum(ex, axis=axis, keepdims=True)
-
 def gelu(x):
     return 0.5*x*(1+tf.tanh(np.sqrt(2/np.pi)*(x+0.044715*tf.pow(x, 3))))
 
 def norm(x, scope, *, axis=-1, epsilon=1e-5):
-    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform.
+    The statistics and the transform are computed in float32 whatever the dtype of x."""
     with tf.variable_scope(scope):
+        dtype = x.dtype
+        x = tf.cast(x, tf.float32)
         n_state = shape_list(x)[-1]
         g = tf.get_variable('g', [n_state], initializer=tf.constant_initializer(1))
         b = tf.get_variable('b', [n_state], initializer=tf.constant_initializer(0))
@@ -44,7 +49,7 @@ def norm(x, scope, *, axis=-1, epsilon=1e-5):
         s = tf.reduce_mean(tf.square(x-u), axis=axis, keepdims=True)
         x = (x - u) * tf.rsqrt(s + epsilon)
         x = x*g + b
-        return x
+        return tf.cast(x, dtype)
 
 def split_states(x, n):
     """Reshape the last dimension of x into [n, x.shape[-1]/n]."""
@@ -56,30 +61,69 @@ def merge_states(x):
     *start, a, b = shape_list(x)
     return tf.reshape(x, start + [a*b])
 
+def cast_variable(var, dtype):
+    """`var` as `dtype`. The variables stay float32; the cast is made once per graph and outside
+    of any loop, so a sampling loop converts the weights once per run, not at every step."""
+    if var.dtype.base_dtype == dtype:
+        return var
+    name = '%s/to_%s' % (var.op.name, dtype.name)
+    with tf.init_scope():
+        graph = tf.get_default_graph()
+        try:
+            return graph.get_tensor_by_name(name + ':0')
+        except KeyError:
+            with tf.name_scope(var.op.name + '/'):
+                return tf.cast(var, dtype, name='to_' + dtype.name)
+
 def conv1d(x, scope, nf, *, w_init_stdev=0.02):
     with tf.variable_scope(scope):
         *start, nx = shape_list(x)
         w = tf.get_variable('w', [1, nx, nf], initializer=tf.random_normal_initializer(stddev=w_init_stdev))
         b = tf.get_variable('b', [nf], initializer=tf.constant_initializer(0))
+        w, b = cast_variable(w, x.dtype), cast_variable(b, x.dtype)
         c = tf.reshape(tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf]))+b, start+[nf])
         return c
 
-def attention_mask(nd, ns, *, dtype):
-    """1's in the lower triangle, counting from the lower right corner.
-
-    Same as tf.matrix_band_part(tf.ones([nd, ns]), -1, ns-nd), but doesn't produce garbage on TPUs.
-    """
-    i = tf.range(nd)[:,None]
-    j = tf.range(ns)
-    m = i >= j - ns + nd
-    return tf.cast(m, dtype)
-
-
-def attn(x, scope, n_state, *, past, hparams):
+def causal_bias(n_ctx, *, dtype=tf.float32):
+    """Additive causal mask for every position below n_ctx: 0 where a query may attend to a key
+    and -1e10 where it may not. Like cast_variable, the constant is made once per graph and
+    outside of any loop, however many times model is called, and attn slices it."""
+    dtype = tf.as_dtype(dtype)
+    name = 'causal_bias_%d_%s' % (n_ctx, dtype.name)
+    with tf.init_scope():
+        graph = tf.get_default_graph()
+        try:
+            return graph.get_tensor_by_name(name + ':0')
+        except KeyError:
+            with tf.name_scope(None):
+                return tf.constant(np.triu(np.full([n_ctx, n_ctx], -1e10, dtype=np.float32), 1), dtype=dtype,
+                                   name=name)
+
+
+def padding_bias(pads, ns, *, dtype):
+    """-1e10 for each row's padding and 0 for every other key, shaped [batch, 1, 1, ns].
+
+    `pads` is (start, lengths): row i has lengths[i] padding tokens from position start on."""
+    start, lengths = pads
+    j = tf.range(ns)[tf.newaxis, :]
+    m = tf.logical_or(j < start, j >= start + lengths[:, tf.newaxis])
+    return ((tf.cast(m, dtype) - 1) * 1e10)[:, tf.newaxis, tf.newaxis, :]
+
+
+def attn(x, scope, n_state, *, past, hparams, past_length=None, pads=None, bias=None):
+    """With `past_length`, `past` is a slice of a preallocated buffer (see past_buffer_shape)
+    of which only the first `past_length` positions are filled; the rest is masked out.
+    With `pads`, each row's padding (see padding_bias) is masked out as well.
+    `bias` is causal_bias(hparams.n_ctx), which model shares between the layers.
+    The attention weights are masked and normalized in float32 whatever the dtype of x."""
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
-        assert past.shape.ndims == 5  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
+        # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
+        # or [2, batch, heads, sequence, features] with past_length
+        assert past.shape.ndims == 5
+    if bias is None:
+        bias = causal_bias(hparams.n_ctx)
 
     def split_heads(x):
         # From [batch, sequence, features] to [batch, heads, sequence, features]
@@ -89,33 +133,59 @@ def attn(x, scope, n_state, *, past, hparams):
         # Reverse of split_heads
         return merge_states(tf.transpose(x, [0, 2, 1, 3]))
 
-    def mask_attn_weights(w):
+    def mask_attn_weights(w, pads=pads):
         # w has shape [batch, heads, dst_sequence, src_sequence], where information flows from src to dst.
         _, _, nd, ns = shape_list(w)
-        b = attention_mask(nd, ns, dtype=w.dtype)
-        b = tf.reshape(b, [1, 1, nd, ns])
-        w = w*b - tf.cast(1e10, w.dtype)*(1-b)
-        return w
+        if isinstance(nd, int) and nd == 1 and pads is None:
+            # A single query may attend to every key
+            return w
+        b = bias[ns-nd:ns, :ns][tf.newaxis, tf.newaxis]
+        if pads is not None:
+            b = b + padding_bias(pads, ns, dtype=w.dtype)
+        return w + b
+
+    def scale(q):
+        # Scaling q instead of the weights is nd*ns multiplies fewer
+        return q * tf.rsqrt(tf.cast(shape_list(q)[-1], q.dtype))
 
     def multihead_attn(q, k, v):
         # q, k, v have shape [batch, heads, sequence, features]
-        w = tf.matmul(q, k, transpose_b=True)
-        w = w * tf.rsqrt(tf.cast(shape_list(v)[-1], w.dtype))
-
+        w = tf.cast(tf.matmul(scale(q), k, transpose_b=True), tf.float32)
         w = mask_attn_weights(w)
-        w = softmax(w)
-        a = tf.matmul(w, v)
+        w = tf.nn.softmax(w)
+        a = tf.matmul(tf.cast(w, v.dtype), v)
         return a
 
+    def buffered_attn(q, k, v, pk, pv):
+        # Attend to the filled part of the buffer and to the new tokens separately, with
+        # one softmax over both, so the buffer is never concatenated with k and v.
+        q = scale(q)
+        w_past = tf.cast(tf.matmul(q, pk, transpose_b=True), tf.float32)
+        ns = shape_list(w_past)[-1]
+        filled = tf.cast(tf.range(ns) < past_length, w_past.dtype)
+        b = tf.reshape((filled - 1) * 1e10, [1, 1, 1, ns])
+        if pads is not None:
+            b = b + padding_bias(pads, ns, dtype=w_past.dtype)
+        w_past = w_past + b
+        # The padding is all in the buffer by now
+        w_new = mask_attn_weights(tf.cast(tf.matmul(q, k, transpose_b=True), tf.float32), pads=None)
+        w = tf.cast(tf.nn.softmax(tf.concat([w_past, w_new], axis=-1)), v.dtype)
+        return tf.matmul(w[:, :, :, :ns], pv) + tf.matmul(w[:, :, :, ns:], v)
+
     with tf.variable_scope(scope):
         c = conv1d(x, 'c_attn', n_state*3)
         q, k, v = map(split_heads, tf.split(c, 3, axis=2))
         present = tf.stack([k, v], axis=1)
-        if past is not None:
-            pk, pv = tf.unstack(past, axis=1)
-            k = tf.concat([pk, k], axis=-2)
-            v = tf.concat([pv, v], axis=-2)
-        a = multihead_attn(q, k, v)
+        if past is not None and past_length is not None:
+            pk, pv = tf.unstack(past, axis=0)
+            a = buffered_attn(q, k, v, pk, pv)
+            present = tf.stack([k, v], axis=0)
+        else:
+            if past is not None:
+                pk, pv = tf.unstack(past, axis=1)
+                k = tf.concat([pk, k], axis=-2)
+                v = tf.concat([pv, v], axis=-2)
+            a = multihead_attn(q, k, v)
         a = merge_heads(a)
         a = conv1d(a, 'c_proj', n_state)
         return a, present
@@ -129,10 +199,11 @@ def mlp(x, scope, n_state, *, hparams):
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, past_length=None, pads=None, bias=None):
     with tf.variable_scope(scope):
         nx = shape_list(x)[-1]
-        a, present = attn(norm(x, 'ln_1'), 'attn', nx, past=past, hparams=hparams)
+        a, present = attn(norm(x, 'ln_1'), 'attn', nx, past=past, hparams=hparams, past_length=past_length, pads=pads,
+                          bias=bias)
         x = x + a
         m = mlp(norm(x, 'ln_2'), 'mlp', nx*4, hparams=hparams)
         x = x + m
@@ -141,19 +212,47 @@ def block(x, scope, *, past, hparams):
 def past_shape(*, hparams, batch_size=None, sequence=None):
     return [batch_size, hparams.n_layer, 2, hparams.n_head, sequence, hparams.n_embd // hparams.n_head]
 
+def past_buffer_shape(*, hparams, batch_size=None, sequence=None):
+    """Layout of a preallocated cache. Layers and k/v come first, because only unstacking the
+    first axis shares memory instead of copying the whole buffer every step."""
+    return [hparams.n_layer, 2, batch_size, hparams.n_head, sequence, hparams.n_embd // hparams.n_head]
+
 def expand_tile(value, size):
     """Add a new axis of given size."""
     value = tf.convert_to_tensor(value, name='value')
     ndims = value.shape.ndims
     return tf.tile(tf.expand_dims(value, axis=0), [size] + [1]*ndims)
 
-def positions_for(tokens, past_length):
+def positions_for(tokens, past_length, pads=None):
     batch_size = tf.shape(tokens)[0]
     nsteps = tf.shape(tokens)[1]
-    return expand_tile(past_length + tf.range(nsteps), batch_size)
+    positions = expand_tile(past_length + tf.range(nsteps), batch_size)
+    if pads is not None:
+        # Tokens after the padding are numbered as if it wasn't there
+        start, lengths = pads
+        lengths = lengths[:, tf.newaxis]
+        positions = tf.where(positions >= start + lengths, positions - lengths, positions)
+    return positions
+
+
+def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE, past_length=None, pads=None,
+          logits_positions=None, dtype=tf.float32):
+    """Run the transformer on X, continuing from the keys/values in `past`.
+
+    If `past_length` is given, `past` is a preallocated cache (see past_buffer_shape and
+    sample.sample_sequence) whose first `past_length` positions are filled, and 'present'
+    is returned in the same layout. Otherwise all of `past` is used.
 
+    `pads` is (start, lengths) for batches of different length sequences: row i has
+    lengths[i] padding tokens from position start on, which nothing attends to and
+    which don't count for the positions of the following tokens.
 
-def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
+    `logits_positions` selects the positions of X to compute 'logits' for, counting from the
+    end if negative, e.g. [-1] when only the next token is needed. Default: all positions.
+
+    `dtype` (e.g. tf.bfloat16, see PRECISIONS) is the dtype of the matmuls, the activations and
+    'present'. The variables, the layer norms, the attention softmax and 'logits' stay float32.
+    """
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -162,20 +261,34 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
                              initializer=tf.random_normal_initializer(stddev=0.01))
         wte = tf.get_variable('wte', [hparams.n_vocab, hparams.n_embd],
                              initializer=tf.random_normal_initializer(stddev=0.02))
-        past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        buffered = past is not None and past_length is not None
+        if not buffered:
+            past_length = 0 if past is None else tf.shape(past)[-2]
+        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length, pads))
+        h = tf.cast(h, dtype)
+        if past is not None:
+            past = tf.cast(past, dtype)
 
         # Transformer
+        bias = causal_bias(hparams.n_ctx)
         presents = []
-        pasts = tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
+        if buffered:
+            pasts = tf.unstack(past, axis=0)
+        else:
+            pasts = tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams)
+            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams,
+                               past_length=past_length if buffered else None, pads=pads, bias=bias)
             if layer == 10:
                 tf.add_to_collection('checkpoints', h)
             presents.append(present)
-        results['present'] = tf.stack(presents, axis=1)
-        h = norm(h, 'ln_f')
+        results['present'] = tf.stack(presents, axis=0 if buffered else 1)
+        h = norm(tf.cast(h, tf.float32), 'ln_f')
+
+        if logits_positions is not None:
+            h = tf.gather(h, tf.math.floormod(logits_positions, sequence), axis=1)
+            sequence = shape_list(h)[1]
 
         # Language model loss.  Do tokens <n predict token n?
         h_flat = tf.reshape(h, [batch*sequence, hparams.n_embd])
@@ -0,0 +1,218 @@
+"""GPT-2 inference in NumPy, with the same math and variable names as model.py.
+
+Only forward passes are supported, which is all sampling needs, and TensorFlow is only
+imported once per checkpoint, to convert it (see load_params).
+"""
+
+import json
+import os
+
+import numpy as np
+
+class HParams(object):
+    def __init__(self, **kwargs):
+        for (k, v) in kwargs.items():
+            setattr(self, k, v)
+
+    def override_from_dict(self, kwargs):
+        for (k, v) in kwargs.items():
+            setattr(self, k, v)
+
+
+def default_hparams():
+    return HParams(
+        n_vocab=0,
+        n_ctx=1024,
+        n_embd=768,
+        n_head=12,
+        n_layer=12,
+    )
+
+def latest_checkpoint(checkpoint_dir):
+    """Same as tf.train.latest_checkpoint, read from the `checkpoint` file."""
+    with open(os.path.join(checkpoint_dir, 'checkpoint')) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key.strip() == 'model_checkpoint_path':
+                path = json.loads(value.strip())
+                return path if os.path.isabs(path) else os.path.join(checkpoint_dir, path)
+    return None
+
+def save_params(path, params):
+    """Write the arrays to an .npz file. Failing to write is not an error."""
+    tmp_path = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+    try:
+        np.savez(tmp_path, **params)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_params(checkpoint, quantized=False):
+    """Read the variables of a checkpoint into a dict of arrays, e.g. 'model/h0/attn/c_attn/w'.
+
+    They are converted once with TensorFlow and kept next to the checkpoint as <checkpoint>.npz,
+    which is loaded instead from then on. With `quantized`, the weights are int8 (see
+    quantize_params) and kept as <checkpoint>.int8.npz."""
+    path = checkpoint + ('.int8.npz' if quantized else '.npz')
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return dict(data)
+
+    if quantized:
+        params = quantize_params(load_params(checkpoint))
+    else:
+        import tensorflow.compat.v1 as tf
+        reader = tf.train.load_checkpoint(checkpoint)
+        params = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+                  if name.startswith('model/')}
+    save_params(path, params)
+    return params
+
+def quantize_params(params):
+    """Quantize the conv1d weights, wte and wpe to int8, with one float32 scale per output channel.
+
+    The scale of 'model/h0/mlp/c_fc/w' is stored as 'model/h0/mlp/c_fc/w/scale'. wte and wpe
+    have one scale per row, which is also the output channel of the logits for wte.
+    Everything else (biases, norms) stays float32."""
+    quantized = {}
+    for name, value in params.items():
+        if name in ('model/wte', 'model/wpe'):
+            channel_axis = 0
+        elif name.endswith('/w'):
+            channel_axis = value.ndim - 1
+        else:
+            quantized[name] = value
+            continue
+        axes = tuple(i for i in range(value.ndim) if i != channel_axis)
+        scale = np.max(np.abs(value), axis=axes, keepdims=True) / 127
+        scale[scale == 0] = 1
+        quantized[name] = np.round(value / scale).astype(np.int8)
+        quantized[name + '/scale'] = scale.reshape(-1).astype(np.float32)
+    return quantized
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+def gelu(x):
+    return 0.5*x*(1+np.tanh(np.float32(np.sqrt(2/np.pi))*(x+0.044715*np.power(x, 3))))
+
+def norm(x, params, scope, *, axis=-1, epsilon=1e-5):
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    u = np.mean(x, axis=axis, keepdims=True)
+    s = np.mean(np.square(x-u), axis=axis, keepdims=True)
+    x = (x - u) / np.sqrt(s + epsilon)
+    return x*params[scope + '/g'] + params[scope + '/b']
+
+# Columns of an int8 weight that are converted to float32 at a time
+DEQUANTIZE_BLOCK = 2048
+
+def matmul(x, w, scale=None):
+    """x @ w, where an int8 `w` is dequantized with its per-column `scale`, a block of
+    columns at a time, so no float32 copy of the whole weight is ever made."""
+    if scale is None:
+        return x @ w
+    out = np.empty(x.shape[:-1] + w.shape[-1:], dtype=np.float32)
+    for j in range(0, w.shape[-1], DEQUANTIZE_BLOCK):
+        out[..., j:j + DEQUANTIZE_BLOCK] = x @ w[:, j:j + DEQUANTIZE_BLOCK].astype(np.float32)
+    out *= scale
+    return out
+
+def embedding(params, name, ids):
+    """Rows `ids` of wte or wpe, dequantized if they are int8."""
+    rows = params[name][ids]
+    if rows.dtype == np.int8:
+        rows = rows.astype(np.float32) * params[name + '/scale'][ids][..., np.newaxis]
+    return rows
+
+def conv1d(x, params, scope):
+    w = params[scope + '/w']
+    return matmul(x, w.reshape(w.shape[-2:]), params.get(scope + '/w/scale')) + params[scope + '/b']
+
+def attention_mask(nd, ns):
+    """True in the lower triangle, counting from the lower right corner."""
+    return np.arange(nd)[:, None] >= np.arange(ns) - ns + nd
+
+def padding_mask(pads, ns):
+    """True for every key except each row's padding, shaped [batch, 1, 1, ns] (see model.padding_bias)."""
+    start, lengths = pads
+    j = np.arange(ns)[np.newaxis, :]
+    m = (j < start) | (j >= start + np.asarray(lengths)[:, np.newaxis])
+    return m[:, np.newaxis, np.newaxis, :]
+
+def attn(x, params, scope, *, past, hparams, pads=None):
+    batch, nd, n_state = x.shape
+    head_dim = n_state // hparams.n_head
+
+    def split_heads(x):
+        # From [batch, sequence, features] to [batch, heads, sequence, features]
+        return x.reshape(batch, nd, hparams.n_head, head_dim).transpose(0, 2, 1, 3)
+
+    q, k, v = map(split_heads, np.split(conv1d(x, params, scope + '/c_attn'), 3, axis=2))
+    present = np.stack([k, v], axis=1)
+    scale = np.float32(1 / np.sqrt(head_dim))
+    w = q @ k.swapaxes(-1, -2) * scale
+    if past is not None:
+        # Attend to the past and to the new tokens with one softmax over both, but without
+        # concatenating the past with k and v.
+        pk, pv = past[:, 0], past[:, 1]
+        w = np.concatenate([q @ pk.swapaxes(-1, -2) * scale, w], axis=-1)
+    ns = w.shape[-1]
+    b = attention_mask(nd, ns)[np.newaxis, np.newaxis]
+    if pads is not None:
+        b = b & padding_mask(pads, ns)
+    w = softmax(np.where(b, w, np.float32(-1e10)))
+    if past is not None:
+        a = w[..., :-nd] @ pv + w[..., -nd:] @ v
+    else:
+        a = w @ v
+
+    # Reverse of split_heads
+    a = a.transpose(0, 2, 1, 3).reshape(batch, nd, n_state)
+    return conv1d(a, params, scope + '/c_proj'), present
+
+def mlp(x, params, scope):
+    h = gelu(conv1d(x, params, scope + '/c_fc'))
+    return conv1d(h, params, scope + '/c_proj')
+
+def block(x, params, scope, *, past, hparams, pads=None):
+    a, present = attn(norm(x, params, scope + '/ln_1'), params, scope + '/attn', past=past, hparams=hparams, pads=pads)
+    x = x + a
+    m = mlp(norm(x, params, scope + '/ln_2'), params, scope + '/mlp')
+    x = x + m
+    return x, present
+
+def positions_for(tokens, past_length, pads=None):
+    batch_size, nsteps = tokens.shape
+    positions = np.broadcast_to(past_length + np.arange(nsteps), (batch_size, nsteps))
+    if pads is not None:
+        # Tokens after the padding are numbered as if it wasn't there
+        start, lengths = pads
+        lengths = np.asarray(lengths)[:, np.newaxis]
+        positions = np.where(positions >= start + lengths, positions - lengths, positions)
+    return positions
+
+def model(params, hparams, X, past=None, pads=None, logits_positions=None):
+    """Same as model.model with arrays: `past` is [batch, n_layer, 2, n_head, sequence, head_dim]
+    (see model.past_shape) and 'present' has the keys/values of X in the same layout."""
+    X = np.asarray(X)
+    results = {}
+    past_length = 0 if past is None else past.shape[-2]
+    h = embedding(params, 'model/wte', X) + embedding(params, 'model/wpe', positions_for(X, past_length, pads))
+
+    # Transformer
+    presents = []
+    for layer in range(hparams.n_layer):
+        h, present = block(h, params, 'model/h%d' % layer, past=None if past is None else past[:, layer],
+                           hparams=hparams, pads=pads)
+        presents.append(present)
+    results['present'] = np.stack(presents, axis=1)
+    h = norm(h, params, 'model/ln_f')
+    if logits_positions is not None:
+        h = h[:, logits_positions]
+
+    # Language model loss.  Do tokens <n predict token n?
+    results['logits'] = matmul(h, params['model/wte'].T, params.get('model/wte/scale'))
+    return results
@@ -0,0 +1,115 @@
+"""sample.sample_sequence for np_model."""
+
+import numpy as np
+
+import np_model
+
+# Same as sample.TOP_P_CANDIDATES
+TOP_P_CANDIDATES = 512
+
+def top_k_logits(logits, k):
+    if k == 0:
+        # no truncation
+        return logits
+    min_values = -np.partition(-logits, k - 1, axis=-1)[:, k - 1, np.newaxis]
+    return np.where(logits < min_values, np.float32(-1e10), logits)
+
+
+def top_p_logits(logits, p, candidates=TOP_P_CANDIDATES):
+    """Same as sample.top_p_logits."""
+    max_logits = np.max(logits, axis=-1, keepdims=True)
+    log_norm = max_logits + np.log(np.sum(np.exp(logits - max_logits), axis=-1, keepdims=True))
+
+    def nucleus_min(logits_sort):
+        probs_sort = np.exp(logits_sort - log_norm)
+        probs_sums = np.cumsum(probs_sort, axis=-1) - probs_sort
+        logits_masked = np.where(probs_sums < p, logits_sort, np.float32(1000))
+        return np.min(logits_masked, axis=-1, keepdims=True)
+
+    min_logits = None
+    if candidates is not None and candidates < logits.shape[-1]:
+        values = -np.sort(np.partition(-logits, candidates - 1, axis=-1)[:, :candidates], axis=-1)
+        if np.all(np.sum(np.exp(values - log_norm), axis=-1) >= p):
+            min_logits = nucleus_min(values)
+    if min_logits is None:
+        min_logits = nucleus_min(-np.sort(-logits, axis=-1))
+    return np.where(logits < min_logits, np.float32(-1e10), logits)
+
+
+def multinomial(logits, rng):
+    """One sample per row of `logits`, shaped [batch, 1]."""
+    probs = np.cumsum(np_model.softmax(logits.astype(np.float64)), axis=-1)
+    u = rng.random_sample((len(probs), 1)) * probs[:, -1:]
+    samples = (probs <= u).sum(axis=-1, keepdims=True)
+    return np.minimum(samples, logits.shape[-1] - 1)
+
+
+def token_log_probs(logits, samples):
+    """Log-probabilities of `samples` [batch, 1] under `logits` [batch, vocab]."""
+    logits = logits.astype(np.float64)
+    max_logits = np.max(logits, axis=-1, keepdims=True)
+    log_norm = max_logits + np.log(np.sum(np.exp(logits - max_logits), axis=-1, keepdims=True))
+    return np.take_along_axis(logits, samples, axis=-1) - log_norm
+
+
+def sample_sequence(*, params, hparams, length, context, temperature=1, top_k=0, top_p=0.0, top_p_within_top_k=False,
+                    stop_tokens=None, soft_stop_tokens=None, min_length=0, pad_token=None, past=None,
+                    pad_lengths=None, rng=np.random, return_log_probs=False):
+    """Same as sample.sample_sequence, with arrays and np_model.
+
+    The keys/values are kept in a buffer allocated once for the whole sequence, and each step
+    attends to the filled part of it. `rng` is a np.random.RandomState (default: the global one).
+    With `return_log_probs`, also returns the rows' log-probabilities, as in sample.sample_sequence.
+    """
+    context = np.asarray(context, dtype=np.int32)
+    batch_size, context_length = context.shape
+    if pad_token is None:
+        pad_token = hparams.n_vocab - 1
+    stop_tokens = np.asarray(list(stop_tokens or []), dtype=np.int32)
+    soft_stop_tokens = np.asarray(list(soft_stop_tokens or []), dtype=np.int32)
+    pads = None
+    if pad_lengths is not None:
+        # The padding starts right after the initial past
+        pads = (0 if past is None else past.shape[-2], pad_lengths)
+
+    # Room for the past, the context and every token sampled after it
+    past_length = 0 if past is None else past.shape[-2]
+    buffer = np.empty(
+        [batch_size, hparams.n_layer, 2, hparams.n_head, past_length + context_length + length - 1,
+         hparams.n_embd // hparams.n_head], dtype=np.float32)
+    if past is not None:
+        buffer[..., :past_length, :] = past
+
+    output = context
+    prev = context
+    finished = np.zeros([batch_size, 1], dtype=bool)
+    log_probs = np.zeros([batch_size, 1])
+    for _ in range(length):
+        lm_output = np_model.model(params, hparams, prev, past=buffer[..., :past_length, :] if past_length else None,
+                                   pads=pads, logits_positions=[-1])
+        presents = lm_output['present']
+        buffer[..., past_length:past_length + presents.shape[-2], :] = presents
+        past_length += presents.shape[-2]
+
+        model_logits = lm_output['logits'][:, -1, :hparams.n_vocab]
+        logits = model_logits / np.float32(temperature)
+        if top_p <= 0.0:
+            logits = top_k_logits(logits, k=top_k)
+        elif top_p_within_top_k:
+            logits = top_p_logits(top_k_logits(logits, k=top_k), p=top_p, candidates=top_k or TOP_P_CANDIDATES)
+        else:
+            logits = top_p_logits(logits, p=top_p)
+        samples = multinomial(logits, rng).astype(np.int32)
+        log_probs += np.where(finished, 0.0, token_log_probs(model_logits, samples))
+        samples = np.where(finished, pad_token, samples)
+        if len(stop_tokens):
+            finished |= np.isin(samples, stop_tokens)
+        if len(soft_stop_tokens) and output.shape[1] - context_length + 1 >= min_length:
+            finished |= np.isin(samples, soft_stop_tokens)
+        output = np.concatenate([output, samples], axis=1)
+        prev = samples
+        if finished.all():
+            break
+    if return_log_probs:
+        return output, log_probs[:, 0]
+    return output
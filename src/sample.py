@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow.compat.v1 as tf
 
 import model
@@ -22,13 +23,33 @@ def top_k_logits(logits, k):
     )
 
 
-def top_p_logits(logits, p):
+# Number of largest logits top_p_logits looks for the nucleus in before sorting them all
+TOP_P_CANDIDATES = 512
+
+def top_p_logits(logits, p, candidates=TOP_P_CANDIDATES):
+    """Keep the smallest set of logits whose probabilities add up to `p`.
+
+    Only the `candidates` largest logits are sorted. If the nucleus of some row doesn't fit
+    in them, every row falls back to sorting the whole vocabulary. candidates=None always sorts.
+    """
     with tf.variable_scope('top_p_logits'):
-        logits_sort = tf.sort(logits, direction='DESCENDING')
-        probs_sort = tf.nn.softmax(logits_sort)
-        probs_sums = tf.cumsum(probs_sort, axis=1, exclusive=True)
-        logits_masked = tf.where(probs_sums < p, logits_sort, tf.ones_like(logits_sort)*1000) # [batchsize, vocab]
-        min_logits = tf.reduce_min(logits_masked, axis=1, keepdims=True) # [batchsize, 1]
+        log_norm = tf.reduce_logsumexp(logits, axis=1, keepdims=True)
+
+        def nucleus_min(logits_sort):
+            probs_sort = tf.exp(logits_sort - log_norm)
+            probs_sums = tf.cumsum(probs_sort, axis=1, exclusive=True)
+            logits_masked = tf.where(probs_sums < p, logits_sort, tf.ones_like(logits_sort)*1000) # [batchsize, candidates]
+            return tf.reduce_min(logits_masked, axis=1, keepdims=True) # [batchsize, 1]
+
+        def sort_all():
+            return nucleus_min(tf.sort(logits, direction='DESCENDING'))
+
+        if candidates is None:
+            min_logits = sort_all()
+        else:
+            values, _ = tf.nn.top_k(logits, k=tf.minimum(candidates, tf.shape(logits)[-1]))
+            covered = tf.reduce_all(tf.reduce_sum(tf.exp(values - log_norm), axis=1) >= p)
+            min_logits = tf.cond(covered, lambda: nucleus_min(values), sort_all)
         return tf.where(
             logits < min_logits,
             tf.ones_like(logits, dtype=logits.dtype) * -1e10,
@@ -36,58 +57,500 @@ def top_p_logits(logits, p):
         )
 
 
-def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=0.0):
+def filter_logits(logits, *, temperature=1, top_k=0, top_p=0.0, top_p_within_top_k=False):
+    """Apply the temperature, then top_p (or top_k if top_p is 0) to [batch, vocab] logits.
+
+    With `top_p_within_top_k`, top_k applies first and top_p after it."""
+    logits = logits / tf.to_float(temperature)
+    if top_p <= 0.0:
+        return top_k_logits(logits, k=top_k)
+    candidates = TOP_P_CANDIDATES
+    if top_p_within_top_k:
+        logits = top_k_logits(logits, k=top_k)
+        if isinstance(top_k, int) and top_k > 0:
+            # After top_k, the nucleus is always among the top_k largest logits
+            candidates = top_k
+    return top_p_logits(logits, p=top_p, candidates=candidates)
+
+
+def is_any(samples, tokens):
+    """Whether each of `samples` is one of `tokens`."""
+    return tf.reduce_any(tf.equal(samples[..., tf.newaxis], tf.constant(list(tokens), dtype=tf.int32)), axis=-1)
+
+
+def token_log_probs(logits, tokens):
+    """Log-probability of each of `tokens` under its `logits` [..., vocab], without temperature or filtering."""
+    return tf.gather(tf.nn.log_softmax(logits), tokens[..., tf.newaxis], batch_dims=len(tokens.shape))[..., 0]
+
+
+def write_past(past, presents, position, *, hparams, batch_size, after=()):
+    """Write the keys/values of one new token into the preallocated cache at `position`.
+
+    The cache is viewed as rows of [head_dim] and the new rows are scattered into it. The
+    scatter reuses the cache's buffer instead of copying it when nothing else still holds it,
+    so the update waits for the ops in `after`, which should include everything that reads
+    `past` in this step."""
+    length, head_dim = model.shape_list(past)[-2:]
+    rows = np.arange(hparams.n_layer * 2 * batch_size * hparams.n_head, dtype=np.int32)
+    flat = tf.reshape(past, [-1, head_dim])
+    with tf.control_dependencies(list(after)):
+        flat = tf.tensor_scatter_nd_update(flat, (rows * length + position)[:, np.newaxis],
+                                           tf.reshape(presents, [-1, head_dim]))
+    return tf.reshape(flat, model.shape_list(past))
+
+
+class PrefixCache(object):
+    """Keys/values of a fixed prompt prefix, computed once and passed as `past` to sample_sequence.
+
+    The cached value belongs to the prefix tokens and the checkpoint it was computed with, and
+    is recomputed whenever `get` is called with a different prefix or checkpoint. It has the
+    model's `dtype`."""
+
+    def __init__(self, hparams, scope='model', dtype=tf.float32):
+        self.tokens = tf.placeholder(tf.int32, [1, None])
+        self.presents = model.model(hparams=hparams, X=self.tokens, scope=scope, reuse=tf.AUTO_REUSE,
+                                    dtype=dtype)['present']
+        self.key = None
+        self.past = None
+
+    def get(self, sess, prefix_tokens, checkpoint, batch_size=1):
+        key = (tuple(prefix_tokens), checkpoint)
+        if key != self.key:
+            self.past = sess.run(self.presents, feed_dict={self.tokens: [prefix_tokens]})
+            self.key = key
+        return np.repeat(self.past, batch_size, axis=0)
+
+
+def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=0.0,
+                    top_p_within_top_k=False, preallocate=False, stop_tokens=None, soft_stop_tokens=None, min_length=0, pad_token=None, past=None,
+                    pad_lengths=None, return_log_probs=False, dtype=tf.float32, slide=None):
+    """Sample `length` tokens after `context` (or after `start_token`).
+
+    Sampling is restricted to the nucleus of probability `top_p`, or to the `top_k` most likely
+    tokens if top_p is 0; either is off when 0. With `top_p_within_top_k`, both apply: the
+    nucleus is taken among the top_k tokens.
+
+    `past` holds the keys/values of tokens that come before `context` (see model.past_shape),
+    e.g. a prompt prefix from PrefixCache, so only `context` has to go through the model.
+
+    Contexts of different lengths are left-padded to a common length, with the number of
+    padding tokens of each row in `pad_lengths`. The padding is ignored by the model.
+
+    With `preallocate`, the key/value cache is allocated once for the whole sequence and each
+    step writes its slice in place, instead of concatenating a new cache every token, and
+    attention is masked to the filled part. Long samples no longer pay for copying the
+    whole cache every token. It needs a static `batch_size`.
+
+    A row is finished once it samples one of `stop_tokens`, or one of `soft_stop_tokens` after
+    at least `min_length` new tokens (e.g. sentence-final punctuation). Later positions of a
+    finished row are filled with `pad_token` (default: the last token of the vocabulary,
+    <|endoftext|> for GPT-2), and the loop exits early once every row has finished, so the
+    result can be shorter than `length`.
+
+    With `return_log_probs`, also returns the model's log-probability of each row's new tokens
+    (at temperature 1, before top_k and top_p), summed up to and including its stop token.
+
+    The model runs in `dtype` (see model.model), which is also the dtype of the cache.
+
+    With `slide`, the context and the sample can be longer than the model's window of n_ctx
+    positions. Whenever the window is full, its oldest `slide` tokens after `past` are dropped
+    and the keys/values of the remaining ones are computed again, at their new positions, so
+    that sampling goes on with the most recent tokens as context. `past` always stays. This
+    costs one forward pass over the window every `slide` tokens, which must leave room for
+    at least one token. It can't be combined with `preallocate`.
+    """
     if start_token is None:
         assert context is not None, 'Specify exactly one of start_token and context!'
     else:
         assert context is None, 'Specify exactly one of start_token and context!'
         context = tf.fill([batch_size, 1], start_token)
+    if pad_token is None:
+        pad_token = hparams.n_vocab - 1
 
-    def step(hparams, tokens, past=None):
-        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE)
+    def step(hparams, tokens, past=None, past_length=None, pads=None):
+        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE, past_length=past_length, pads=pads,
+                                logits_positions=[-1], dtype=dtype)
 
         logits = lm_output['logits'][:, :, :hparams.n_vocab]
         presents = lm_output['present']
-        presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size))
+        if past_length is None:
+            presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size))
+        else:
+            presents.set_shape(model.past_buffer_shape(hparams=hparams, batch_size=batch_size))
         return {
             'logits': logits,
             'presents': presents,
         }
 
     with tf.name_scope('sample_sequence'):
-        def body(past, prev, output):
-            next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs['logits'][:, -1, :]  / tf.to_float(temperature)
-            if top_p > 0.0:
-                logits = top_p_logits(logits, p=top_p)
-            else:
-                logits = top_k_logits(logits, k=top_k)
-            samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+        context_length = tf.shape(context)[1]
+        if past is not None:
+            past = tf.cast(past, dtype)
+        pads = None
+        if pad_lengths is not None:
+            # The padding starts right after the initial past
+            pads = (0 if past is None else tf.shape(past)[-2], pad_lengths)
+
+        def next_token(logits, output, finished, log_probs):
+            logits = logits[:, -1, :]
+            samples = tf.multinomial(filter_logits(logits, temperature=temperature, top_k=top_k, top_p=top_p,
+                                                   top_p_within_top_k=top_p_within_top_k),
+                                     num_samples=1, output_dtype=tf.int32)
+            log_probs += tf.where(finished, tf.zeros_like(log_probs), token_log_probs(logits[:, tf.newaxis], samples))
+            samples = tf.where(finished, tf.fill(tf.shape(samples), pad_token), samples)
+            if stop_tokens:
+                finished = tf.logical_or(finished, is_any(samples, stop_tokens))
+            if soft_stop_tokens:
+                long_enough = tf.shape(output)[1] - context_length + 1 >= min_length
+                finished = tf.logical_or(finished, tf.logical_and(long_enough, is_any(samples, soft_stop_tokens)))
+            return samples, finished, log_probs
+
+        def body(past, prev, output, finished, log_probs):
+            next_outputs = step(hparams, prev, past=past, pads=pads)
+            samples, finished, log_probs = next_token(next_outputs['logits'], output, finished, log_probs)
             return [
                 next_outputs['presents'] if past is None else tf.concat([past, next_outputs['presents']], axis=-2),
                 samples,
-                tf.concat([output, samples], axis=1)
+                tf.concat([output, samples], axis=1),
+                finished,
+                log_probs,
+            ]
+
+        def body_preallocated(past, past_length, prev, output, finished, log_probs):
+            next_outputs = step(hparams, prev, past=past, past_length=past_length, pads=pads)
+            samples, finished, log_probs = next_token(next_outputs['logits'], output, finished, log_probs)
+            return [
+                write_past(past, next_outputs['presents'], past_length, hparams=hparams, batch_size=batch_size,
+                           after=[samples]),
+                past_length + 1,
+                samples,
+                tf.concat([output, samples], axis=1),
+                finished,
+                log_probs,
             ]
 
-        past, prev, output = body(None, context, context)
+        # finished and log_probs are [batch, 1] to line up with the samples
+        finished = tf.zeros([tf.shape(context)[0], 1], dtype=tf.bool)
+        log_probs = tf.zeros([tf.shape(context)[0], 1])
 
         def cond(*args):
-            return True
+            return tf.logical_not(tf.reduce_all(args[-2]))
+
+        def result(tokens, log_probs):
+            return (tokens, log_probs[:, 0]) if return_log_probs else tokens
+
+        if slide is not None:
+            assert not preallocate, "slide can't be combined with preallocate"
+            prefix = past
+            prefix_length = 0 if prefix is None else model.shape_list(prefix)[-2]
+            if slide < 1:
+                raise ValueError('slide must be at least 1, got %s' % slide)
+            if isinstance(prefix_length, int):
+                if slide >= hparams.n_ctx - prefix_length:
+                    raise ValueError("slide=%s leaves no room in a window of %s positions after a prefix of %s" % (
+                        slide, hparams.n_ctx, prefix_length))
+            else:
+                with tf.control_dependencies([tf.debugging.assert_less(
+                        slide, hparams.n_ctx - prefix_length, message='slide leaves no room after the prefix')]):
+                    prefix_length = tf.identity(prefix_length)
+            # Tokens kept in the window after a slide, before the token being fed
+            keep = hparams.n_ctx - prefix_length - slide
+            if pad_lengths is None:
+                pad_lengths = tf.zeros([tf.shape(context)[0]], dtype=tf.int32)
+            context_pad_lengths = pad_lengths
+
+            def window(tokens, size, pad_lengths):
+                # The last `size` of `tokens`, and how much of each row's padding is left in them
+                size = tf.minimum(size, tf.shape(tokens)[1])
+                dropped = tf.shape(tokens)[1] - size
+                return tokens[:, dropped:], tf.maximum(pad_lengths - dropped, 0)
+
+            def fill(tokens, pad_lengths):
+                # The keys/values of `tokens` after the prefix, and the next token's logits
+                lm_output = model.model(hparams=hparams, X=tokens, past=prefix, reuse=tf.AUTO_REUSE,
+                                        pads=(prefix_length, pad_lengths), logits_positions=[-1], dtype=dtype)
+                presents = lm_output['present']
+                presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size))
+                if prefix is not None:
+                    presents = tf.concat([prefix, presents], axis=-2)
+                return presents, lm_output['logits'][:, :, :hparams.n_vocab]
 
-        _, _, tokens = tf.while_loop(
+            def body_sliding(past, pad_lengths, prev, output, finished, log_probs):
+                def refill():
+                    recent, lengths = window(output[:, :-1], keep, context_pad_lengths)
+                    return fill(recent, lengths)[0], lengths
+
+                past, pad_lengths = tf.cond(tf.shape(past)[-2] >= hparams.n_ctx, refill, lambda: (past, pad_lengths))
+                next_outputs = step(hparams, prev, past=past, pads=(prefix_length, pad_lengths))
+                samples, finished, log_probs = next_token(next_outputs['logits'], output, finished, log_probs)
+                return [
+                    tf.concat([past, next_outputs['presents']], axis=-2),
+                    pad_lengths,
+                    samples,
+                    tf.concat([output, samples], axis=1),
+                    finished,
+                    log_probs,
+                ]
+
+            # A context that doesn't fit is cut to its last n_ctx - 1 tokens, which leaves room for the first sample
+            recent, pad_lengths = window(context, hparams.n_ctx - prefix_length - 1, context_pad_lengths)
+            past, logits = fill(recent, pad_lengths)
+            prev, finished, log_probs = next_token(logits, context, finished, log_probs)
+            _, _, _, tokens, _, log_probs = tf.while_loop(
+                cond=cond, body=body_sliding,
+                maximum_iterations=length - 1,
+                loop_vars=[
+                    past,
+                    pad_lengths,
+                    prev,
+                    tf.concat([context, prev], axis=1),
+                    finished,
+                    log_probs,
+                ],
+                shape_invariants=[
+                    tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size)),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size, 1]),
+                    tf.TensorShape([batch_size, None]),
+                    tf.TensorShape([batch_size, 1]),
+                    tf.TensorShape([batch_size, 1]),
+                ],
+                back_prop=False,
+            )
+            return result(tokens, log_probs)
+
+        past, prev, output, finished, log_probs = body(past, context, context, finished, log_probs)
+
+        if preallocate:
+            assert batch_size is not None, 'preallocate needs a static batch_size'
+            # Room for the prefix, the context and every token sampled after it
+            past_length = tf.shape(past)[-2]
+            past = tf.transpose(past, [1, 2, 0, 3, 4, 5])
+            past = tf.pad(past, [[0, 0]] * 4 + [[0, length - 1], [0, 0]])
+            _, _, _, tokens, _, log_probs = tf.while_loop(
+                cond=cond, body=body_preallocated,
+                maximum_iterations=length - 1,
+                loop_vars=[
+                    past,
+                    past_length,
+                    prev,
+                    output,
+                    finished,
+                    log_probs,
+                ],
+                shape_invariants=[
+                    tf.TensorShape(model.past_buffer_shape(hparams=hparams, batch_size=batch_size)),
+                    tf.TensorShape([]),
+                    tf.TensorShape([batch_size, 1]),
+                    tf.TensorShape([batch_size, None]),
+                    tf.TensorShape([batch_size, 1]),
+                    tf.TensorShape([batch_size, 1]),
+                ],
+                back_prop=False,
+            )
+            return result(tokens, log_probs)
+
+        _, _, tokens, _, log_probs = tf.while_loop(
             cond=cond, body=body,
             maximum_iterations=length - 1,
             loop_vars=[
                 past,
                 prev,
-                output
+                output,
+                finished,
+                log_probs,
             ],
             shape_invariants=[
                 tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size)),
+                tf.TensorShape([batch_size, 1]),
                 tf.TensorShape([batch_size, None]),
-                tf.TensorShape([batch_size, None]),
+                tf.TensorShape([batch_size, 1]),
+                tf.TensorShape([batch_size, 1]),
+            ],
+            back_prop=False,
+        )
+
+        return result(tokens, log_probs)
+
+
+def speculative_sample_sequence(*, hparams, draft_hparams, length, context, draft_k=4, draft_scope='draft',
+                                temperature=1, top_k=0, top_p=0.0, top_p_within_top_k=False,
+                                stop_tokens=None, soft_stop_tokens=None,
+                                min_length=0, pad_token=None, past=None, draft_past=None, pad_lengths=None,
+                                return_log_probs=False, dtype=tf.float32):
+    """Sample like sample_sequence, with a smaller draft model (its variables under `draft_scope`)
+    proposing `draft_k` tokens at a time, which the model then scores in one forward pass.
+
+    Each draft token is accepted with probability min(1, p/q), where p and q are the model's and the
+    draft's probabilities after temperature, top_k and top_p. The first rejected token is replaced
+    by a sample from max(0, p - q), normalized. If every draft token is accepted, one more token is
+    sampled from p. The result has the same distribution as sampling from the model alone.
+
+    All rows of a batch share their key/value caches' length, so every row keeps as many tokens
+    per step as the row that accepted the fewest. Its own next token is still sampled correctly.
+    `past` and `draft_past` are the two models' keys/values before `context`, e.g. a prompt
+    prefix from PrefixCache (with scope=draft_scope for the draft).
+
+    Returns the tokens and a dict of counters, summed over the loop's iterations:
+    'steps' (forward passes of the model), 'drafted' and 'accepted' (draft tokens proposed and
+    accepted, over the unfinished rows) and 'kept' (accepted draft tokens kept for the batch).
+    With `return_log_probs`, returns the tokens, their log-probabilities as in sample_sequence and
+    the counters. Both models run in `dtype`.
+    """
+    assert draft_hparams.n_vocab == hparams.n_vocab, 'The draft model needs the same vocabulary'
+    if pad_token is None:
+        pad_token = hparams.n_vocab - 1
+
+    def pads_for(past):
+        # The padding starts right after the initial past
+        return None if pad_lengths is None else (0 if past is None else tf.shape(past)[-2], pad_lengths)
+
+    target_pads = pads_for(past)
+    draft_pads = pads_for(draft_past)
+
+    def target_step(tokens, past, logits_positions=None):
+        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE, pads=target_pads,
+                                logits_positions=logits_positions, dtype=dtype)
+        present = lm_output['present']
+        return lm_output['logits'][:, :, :hparams.n_vocab], present if past is None else tf.concat([past, present], axis=-2)
+
+    def draft_step(tokens, past):
+        lm_output = model.model(hparams=draft_hparams, X=tokens, past=past, scope=draft_scope, reuse=tf.AUTO_REUSE,
+                                pads=draft_pads, logits_positions=[-1], dtype=dtype)
+        present = lm_output['present']
+        return lm_output['logits'][:, -1, :hparams.n_vocab], present if past is None else tf.concat([past, present], axis=-2)
+
+    def filtered_log_probs(logits):
+        # [..., vocab] logits to log-probabilities of the filtered distribution
+        flat = tf.reshape(logits, [-1, hparams.n_vocab])
+        flat = filter_logits(flat, temperature=temperature, top_k=top_k, top_p=top_p,
+                             top_p_within_top_k=top_p_within_top_k)
+        return tf.reshape(tf.nn.log_softmax(flat), tf.shape(logits))
+
+    with tf.name_scope('speculative_sample_sequence'):
+        if past is not None:
+            past = tf.cast(past, dtype)
+        if draft_past is not None:
+            draft_past = tf.cast(draft_past, dtype)
+        batch_size = tf.shape(context)[0]
+        context_length = tf.shape(context)[1]
+
+        def finish(tokens, output, finished):
+            # Finish each row at its first stop token, and pad every token after it
+            stop = tf.zeros(tf.shape(tokens), dtype=tf.bool)
+            if stop_tokens:
+                stop = tf.logical_or(stop, is_any(tokens, stop_tokens))
+            if soft_stop_tokens:
+                generated = tf.shape(output)[1] - context_length + tf.range(tf.shape(tokens)[1]) + 1
+                stop = tf.logical_or(stop, tf.logical_and(generated >= min_length, is_any(tokens, soft_stop_tokens)))
+            stopped = tf.logical_or(finished, tf.cumsum(tf.cast(stop, tf.int32), axis=1, exclusive=True) > 0)
+            tokens = tf.where(stopped, tf.fill(tf.shape(tokens), pad_token), tokens)
+            return tokens, stopped, tf.logical_or(stopped, stop)[:, -1, tf.newaxis]
+
+        def sum_log_probs(logits, tokens, output, stopped):
+            # The model's log-probabilities of the tokens before the padding, up to `length`
+            log_probs = token_log_probs(logits, tokens)
+            generated = tf.shape(output)[1] - context_length + tf.range(tf.shape(tokens)[1])
+            skip = tf.logical_or(stopped, generated >= length)
+            return tf.reduce_sum(tf.where(skip, tf.zeros_like(log_probs), log_probs), axis=1)
+
+        # Both models go through the context; the model samples the first token itself
+        logits, target_past = target_step(context, past, logits_positions=[-1])
+        _, draft_past = draft_step(context, draft_past)
+        samples = tf.multinomial(filtered_log_probs(logits[:, -1]), num_samples=1, output_dtype=tf.int32)
+        samples, stopped, finished = finish(samples, context, tf.zeros([batch_size, 1], dtype=tf.bool))
+        log_probs = sum_log_probs(logits, samples, context, stopped)
+        output = tf.concat([context, samples], axis=1)
+
+        def body(target_past, draft_past, prev, pending, output, finished, log_probs, stats):
+            # `prev` is the last token, which the model hasn't seen yet. `pending` are the
+            # tokens the draft model hasn't seen: prev, after the last draft token if it was kept.
+            draft_length = tf.shape(draft_past)[-2]
+            drafts, draft_log_probs = [], []
+            new_past = draft_past
+            tokens = pending
+            for _ in range(draft_k):
+                logits, new_past = draft_step(tokens, new_past)
+                q = filtered_log_probs(logits)
+                tokens = tf.multinomial(q, num_samples=1, output_dtype=tf.int32)
+                drafts.append(tokens)
+                draft_log_probs.append(q)
+            drafts = tf.concat(drafts, axis=1) # [batch, draft_k]
+            q = tf.stack(draft_log_probs, axis=1) # [batch, draft_k, vocab]
+
+            logits, new_target_past = target_step(tf.concat([prev, drafts], axis=1), target_past)
+            p = filtered_log_probs(logits) # [batch, draft_k + 1, vocab]
+
+            # Accept draft token i with probability min(1, p_i/q_i), up to the first rejection
+            p_drafts = tf.gather(p[:, :-1], drafts[..., tf.newaxis], batch_dims=2)[..., 0]
+            q_drafts = tf.gather(q, drafts[..., tf.newaxis], batch_dims=2)[..., 0]
+            accept = tf.log(tf.random.uniform(tf.shape(drafts))) < p_drafts - q_drafts
+            accepted = tf.reduce_sum(tf.cumprod(tf.cast(accept, tf.int32), axis=1), axis=1)
+            active = tf.logical_not(finished[:, 0])
+            accepted = tf.where(active, accepted, tf.fill(tf.shape(accepted), draft_k))
+            kept = tf.reduce_min(accepted)
+
+            # The token after the kept ones: the row's own draft token if it was accepted,
+            # otherwise a sample from max(0, p - q) (just p after all draft_k tokens)
+            q_next = tf.pad(tf.exp(q), [[0, 0], [0, 1], [0, 0]])[:, kept]
+            residual = tf.nn.relu(tf.exp(p[:, kept]) - q_next)
+            resampled = tf.multinomial(tf.log(tf.maximum(residual, 1e-30)), num_samples=1, output_dtype=tf.int32)
+            own = tf.pad(drafts, [[0, 0], [0, 1]])[:, kept, tf.newaxis]
+            samples = tf.where((accepted > kept)[:, tf.newaxis], own, resampled)
+            samples, stopped, new_finished = finish(tf.concat([drafts[:, :kept], samples], axis=1), output, finished)
+            log_probs += sum_log_probs(logits[:, :kept + 1], samples, output, stopped)
+
+            # Keep the keys/values of the tokens before the last one. The draft model has
+            # seen every draft token but the last.
+            seen = tf.minimum(kept, draft_k - 1)
+            stats = {
+                'steps': stats['steps'] + 1,
+                'drafted': stats['drafted'] + draft_k * tf.reduce_sum(tf.cast(active, tf.int32)),
+                'accepted': stats['accepted'] + tf.reduce_sum(tf.where(active, accepted, tf.zeros_like(accepted))),
+                'kept': stats['kept'] + kept,
+            }
+            return [
+                new_target_past[..., :tf.shape(target_past)[-2] + kept + 1, :],
+                new_past[..., :draft_length + tf.shape(pending)[1] + seen, :],
+                samples[:, -1, tf.newaxis],
+                samples[:, seen:],
+                tf.concat([output, samples], axis=1),
+                new_finished,
+                log_probs,
+                stats,
+            ]
+
+        def cond(target_past, draft_past, prev, pending, output, finished, log_probs, stats):
+            return tf.logical_and(tf.shape(output)[1] - context_length < length,
+                                  tf.logical_not(tf.reduce_all(finished)))
+
+        stats = {name: tf.constant(0) for name in ('steps', 'drafted', 'accepted', 'kept')}
+        _, _, _, _, tokens, _, log_probs, stats = tf.while_loop(
+            cond=cond, body=body,
+            loop_vars=[
+                target_past,
+                draft_past,
+                samples,
+                samples,
+                output,
+                finished,
+                log_probs,
+                stats,
+            ],
+            shape_invariants=[
+                tf.TensorShape(model.past_shape(hparams=hparams)),
+                tf.TensorShape(model.past_shape(hparams=draft_hparams)),
+                tf.TensorShape([None, 1]),
+                tf.TensorShape([None, None]),
+                tf.TensorShape([None, None]),
+                tf.TensorShape([None, 1]),
+                tf.TensorShape([None]),
+                {name: tf.TensorShape([]) for name in stats},
             ],
             back_prop=False,
         )
 
-        return tokens
+        tokens = tokens[:, :context_length + length]
+        if return_log_probs:
+            return tokens, log_probs, stats
+        return tokens, stats
@@ -24,11 +24,11 @@ def splice_tensor(ten, new_op):
     return new_op.outputs[i]
 
 def splice(obj, input_map, control_inputs=None):
-    if type(obj) is tf.Operation:
+    if isinstance(obj, tf.Operation):
         return splice_op(obj, input_map, control_inputs=control_inputs)
-    elif type(obj) is tf.Tensor:
+    elif isinstance(obj, tf.Tensor):
         return splice_tensor(obj, input_map.get(obj.op, obj.op))
-    elif type(obj) is tf.IndexedSlices:
+    elif isinstance(obj, tf.IndexedSlices):
         return tf.IndexedSlices(values=input_map.get(obj.values, obj.values),
                                 indices=input_map.get(obj.indices, obj.indices),
                                 dense_shape=input_map.get(obj.dense_shape, obj.dense_shape))
@@ -64,11 +64,11 @@ def graph_from_dfs(deps, starts):
     return {x : list(deps(x)) for x in visited}
 
 def get_deps(obj):
-    if type(obj) is tf.Operation:
+    if isinstance(obj, tf.Operation):
         return list(obj.inputs) + list(obj.control_inputs)
-    elif type(obj) is tf.Tensor:
+    elif isinstance(obj, tf.Tensor):
         return [obj.op]
-    elif type(obj) is tf.IndexedSlices:
+    elif isinstance(obj, tf.IndexedSlices):
         return [obj.indices, obj.values, obj.dense_shape]
     else:
         raise AssertionError(f'Could not get deps from{repr(type(obj))} {repr(obj)}')
@@ -78,7 +78,7 @@ def tensor_graph(compute):
     return graph_from_dfs(get_deps, list(compute))
 
 def blacklist(obj):
-    if type(obj) is tf.Operation:
+    if isinstance(obj, tf.Operation):
         if 'Assign' in obj.type or 'Variable' in obj.type or 'Placeholder' in obj.type:
             # TODO: Should we do special accounting for
             # ReadVariableOp? Currently we forbid cloning altogether,
@@ -88,12 +88,12 @@ def blacklist(obj):
             # ReadVariableOp (is it copy-on-write?).
             # https://www.tensorflow.org/api_docs/python/tf/raw_ops/ReadVariableOp?hl=uk
             return True
-    elif type(obj) is tf.Tensor:
+    elif isinstance(obj, tf.Tensor):
         return blacklist(obj.op)
     return False
 
 def estimate_cpu(op):
-    return sum(4 * shape_size(t.shape) for t in op.inputs if type(t) is tf.Tensor) + sum(4 * shape_size(t.shape) for t in op.outputs)
+    return sum(4 * shape_size(t.shape) for t in op.inputs if isinstance(t, tf.Tensor)) + sum(4 * shape_size(t.shape) for t in op.outputs)
 
 def estimate_mem(op):
     return sum(4 * shape_size(t.shape) for t in op.outputs)
@@ -101,15 +101,15 @@ def estimate_mem(op):
 def info(op):
     if blacklist(op):
         return {'type': 'effectful'}
-    elif type(op) is tf.Operation:
+    elif isinstance(op, tf.Operation):
         if 'Reshape' in op.type:
             return {'type': 'pointer'}
         return {'type': 'normal',
                 'cpu': estimate_cpu(op),
                 'mem': estimate_mem(op)}
-    elif type(op) is tf.Tensor:
+    elif isinstance(op, tf.Tensor):
         return {'type': 'pointer'}
-    elif type(op) is tf.IndexedSlices:
+    elif isinstance(op, tf.IndexedSlices):
         return {'type': 'pointer'}
     else:
         raise AssertionError(repr((type(op), op)))
@@ -173,7 +173,7 @@ def tf_remat(compute, memlimit):
                 live[base] = base
             else:
                 live[base] = splice(base, input_map, control_inputs=[last_op])
-            if type(base) is tf.Operation:
+            if isinstance(base, tf.Operation):
                 last_op = live[base]
         elif action == 'free':
             del live[base]
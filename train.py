@@ -26,7 +26,8 @@ if tf.VERSION >= '2':
 
 
 import model, sample, encoder
-from load_dataset import load_dataset, Sampler
+from load_dataset import load_dataset, Sampler, sample_batches
+from accumulate import AccumulatingOptimizer
 
 CHECKPOINT_DIR = 'checkpoint'
 SAMPLE_DIR = 'samples'
@@ -36,7 +37,7 @@ parser = argparse.ArgumentParser(
     description='Fine-tune GPT-2 on your custom dataset.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-parser.add_argument('--dataset', metavar='PATH', type=str, required=True, help='Input file, directory, or glob pattern (utf-8 text, or preencoded .npz files).')
+parser.add_argument('--dataset', metavar='PATH', type=str, required=True, help='Input file, directory, or glob pattern (utf-8 text, or preencoded .npz or .tokens files).')
 parser.add_argument('--model_name', metavar='MODEL', type=str, default='124M', help='Pretrained model name')
 parser.add_argument('--models_dir', metavar='PATH', type=str, default='models', help='Path to models directory')
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate input files with <|endoftext|> separator into chunks of this minimum size')
@@ -50,10 +51,13 @@ parser.add_argument('--twremat', default=False, action='store_true', help='Use t
 parser.add_argument('--twremat_memlimit', type=str, default='12G', help='Memory usage limit/target for twremat. Can be an integer, or an integer suffixed with K/M/G for kilo/mega/giga-bytes.')
 parser.add_argument('--only_train_transformer_layers', default=False, action='store_true', help='Restrict training to the transformer blocks.')
 parser.add_argument('--optimizer', type=str, default='adam', help='Optimizer. <adam|sgd>.')
+parser.add_argument('--prefetch', metavar='N', type=int, default=4, help='Sample up to N batches ahead, in a background thread.')
 parser.add_argument('--noise', type=float, default=0.0, help='Add noise to input training data to regularize against typos.')
+parser.add_argument('--precision', type=str, default='float32', choices=sorted(model.PRECISIONS), help='Dtype of the matmuls and activations. The weights stay float32. float16 uses dynamic loss scaling.')
 
 parser.add_argument('--top_k', type=int, default=40, help='K for top-k sampling.')
-parser.add_argument('--top_p', type=float, default=0.0, help='P for top-p sampling. Overrides top_k if set > 0.')
+parser.add_argument('--top_p', type=float, default=0.0, help='P for top-p sampling, which ignores --top_k. 0 to disable.')
+parser.add_argument('--top_p_within_top_k', default=False, action='store_true', help='Apply both --top_k and --top_p, the nucleus being taken among the top_k tokens.')
 
 parser.add_argument('--restore_from', type=str, default='latest', help='Either "latest", "fresh", or a path to a checkpoint file')
 parser.add_argument('--run_name', type=str, default='run1', help='Run id. Name of subdirectory in checkpoint/ and samples/')
@@ -95,19 +99,23 @@ def main():
         raise ValueError(
             "Can't get samples longer than window size: %s" % hparams.n_ctx)
 
-    with tf.Session() as sess:
+    # The input pipeline needs an inter-op thread of its own (see sample_batches)
+    config = tf.ConfigProto(inter_op_parallelism_threads=max(2, os.cpu_count() or 1))
+    with tf.Session(config=config) as sess:
         # Fully static shape required to make memory accounting in
-        # twremat accurate.
-        train_context = tf.placeholder(tf.int32, [args.batch_size, 1024])
+        # twremat accurate. Each step reads its batch from this variable,
+        # which load_batch fills from the input pipeline beforehand.
+        train_context = tf.Variable(tf.zeros([args.batch_size, 1024], dtype=tf.int32), trainable=False)
         train_context_in = randomize(train_context, hparams, args.noise)
-        train_output = model.model(hparams=hparams, X=train_context_in)
+        dtype = model.PRECISIONS[args.precision]
+        train_output = model.model(hparams=hparams, X=train_context_in, dtype=dtype)
         train_loss = tf.reduce_mean(
             tf.nn.sparse_softmax_cross_entropy_with_logits(
                 labels=train_context[:, 1:], logits=train_output['logits'][:, :-1]))
 
         if args.val_every > 0:
             val_context = tf.placeholder(tf.int32, [args.val_batch_size, None])
-            val_output = model.model(hparams=hparams, X=val_context)
+            val_output = model.model(hparams=hparams, X=val_context, dtype=dtype)
             val_loss = tf.reduce_mean(
                 tf.nn.sparse_softmax_cross_entropy_with_logits(
                     labels=val_context[:, 1:], logits=val_output['logits'][:, :-1]))
@@ -121,7 +129,10 @@ def main():
             batch_size=args.batch_size,
             temperature=1.0,
             top_k=args.top_k,
-            top_p=args.top_p)
+            top_p=args.top_p,
+            top_p_within_top_k=args.top_p_within_top_k,
+            preallocate=True,
+            dtype=dtype)
 
         all_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
         train_vars = [v for v in all_vars if '/h' in v.name] if args.only_train_transformer_layers else all_vars
@@ -135,19 +146,42 @@ def main():
         else:
             exit('Bad optimizer:', args.optimizer)
 
+        # float16 gradients underflow, so the loss is scaled up and the gradients back down.
+        # A step whose gradients overflow is skipped, and the scale lowered.
+        scaled_loss = train_loss
+        if dtype == tf.float16:
+            loss_scale = tf.train.experimental.DynamicLossScale()
+            scaled_loss = train_loss * loss_scale()
+
         if args.memory_saving_gradients:
             if tf.VERSION >= '2':
                 exit('Memory saving gradients are not supported in tensorflow 2.x')
             import memory_saving_gradients
-            opt_grads = memory_saving_gradients.gradients(train_loss, train_vars)
+            opt_grads = memory_saving_gradients.gradients(scaled_loss, train_vars)
         elif args.twremat:
             import tfremat
-            opt_grads = tf.gradients(train_loss, train_vars)
+            opt_grads = tf.gradients(scaled_loss, train_vars)
             (train_loss, opt_grads) = tfremat.tf_remat((train_loss, opt_grads), memlimit=args.twremat_memlimit)
         else:
-            opt_grads = tf.gradients(train_loss, train_vars)
-        opt_grads = list(zip(opt_grads, train_vars))
-        opt_apply = opt.apply_gradients(opt_grads)
+            opt_grads = tf.gradients(scaled_loss, train_vars)
+        if dtype == tf.float16:
+            opt_grads = [g / loss_scale() for g in opt_grads]
+
+        def apply_gradients(grads):
+            if dtype == tf.float16:
+                update_loss_scale, finite = loss_scale.update([g for g, _ in grads])
+                return tf.group(tf.cond(finite, lambda: opt.apply_gradients(grads), tf.no_op), update_loss_scale)
+            return opt.apply_gradients(grads)
+
+        if args.accumulate_gradients > 1:
+            # Gradients of several batches are summed up, and the optimizer steps with their mean
+            accumulator = AccumulatingOptimizer(opt=opt, var_list=train_vars)
+            opt_reset = accumulator.reset()
+            opt_compute = accumulator.compute_gradients(train_loss, grads=opt_grads)
+            train_loss = accumulator.apply_gradients(apply_gradients)
+            opt_apply = train_loss
+        else:
+            opt_apply = apply_gradients(list(zip(opt_grads, train_vars)))
         summary_loss = tf.summary.scalar('loss', train_loss)
 
         # if args.twremat:
@@ -190,6 +224,10 @@ def main():
         print('Loading dataset...')
         chunks = load_dataset(enc, args.dataset, args.combine, encoding=args.encoding)
         data_sampler = Sampler(chunks)
+        train_batches = tf.data.make_initializable_iterator(
+            sample_batches(data_sampler, args.batch_size, 1024, prefetch=args.prefetch))
+        load_batch = train_context.assign(train_batches.get_next()).op
+        sess.run(train_batches.initializer)
         if args.val_every > 0:
             if args.val_dataset:
                 val_chunks = load_dataset(enc, args.val_dataset, args.combine, encoding=args.encoding)
@@ -202,7 +240,7 @@ def main():
             # Sample from validation set once with fixed seed to make
             # it deterministic during training as well as across runs.
             val_data_sampler = Sampler(val_chunks, seed=1)
-            val_batches = [[val_data_sampler.sample(1024) for _ in range(args.val_batch_size)]
+            val_batches = [val_data_sampler.sample_batch(args.val_batch_size, 1024)
                            for _ in range(args.val_batch_count)]
 
         counter = 1
@@ -264,16 +302,39 @@ def main():
                     time=time.time() - start_time,
                     loss=v_val_loss))
 
-        def sample_batch():
-            return [data_sampler.sample(1024) for _ in range(args.batch_size)]
+        def train_step():
+            # Returns the step's results and the seconds it spent waiting for
+            # batches and computing
+            timings = [0.0, 0.0]
+
+            def run(fetches):
+                start = time.time()
+                sess.run(load_batch)
+                loaded = time.time()
+                result = sess.run(fetches)
+                timings[0] += loaded - start
+                timings[1] += time.time() - loaded
+                return result
+
+            if args.accumulate_gradients > 1:
+                sess.run(opt_reset)
+                for _ in range(args.accumulate_gradients):
+                    run(opt_compute)
+                start = time.time()
+                result = sess.run((opt_apply, train_loss, summaries))
+                timings[1] += time.time() - start
+                return result, timings
+            return run((opt_apply, train_loss, summaries)), timings
 
 
         avg_loss = (0.0, 0.0)
+        tokens_per_step = args.batch_size * args.accumulate_gradients * 1024
+        print('{} tokens per optimizer step'.format(tokens_per_step))
         start_time = time.time()
 
         # print('Evaluating grads..')
         # tf2.profiler.experimental.start('logdir')
-        # sess.run((opt_apply, train_loss, summaries), feed_dict={train_context: sample_batch()})
+        # train_step()
         # tf2.profiler.experimental.stop()
         # print('Succeeded')
         # exit()
@@ -287,9 +348,7 @@ def main():
                 if args.val_every > 0 and (counter % args.val_every == 0 or counter == 1):
                     validation()
 
-                (_, v_loss, v_summary) = sess.run(
-                    (opt_apply, train_loss, summaries),
-                    feed_dict={train_context: sample_batch()})
+                ((_, v_loss, v_summary), (input_time, compute_time)) = train_step()
 
                 summary_log.add_summary(v_summary, counter)
 
@@ -297,12 +356,15 @@ def main():
                             avg_loss[1] * 0.99 + 1.0)
 
                 print(
-                    '[{counter} | {time:2.2f}] loss={loss:2.2f} avg={avg:2.2f}'
+                    '[{counter} | {time:2.2f}] loss={loss:2.2f} avg={avg:2.2f} tokens/s={rate:2.1f} input={input:2.3f}s compute={compute:2.2f}s'
                     .format(
                         counter=counter,
                         time=time.time() - start_time,
                         loss=v_loss,
-                        avg=avg_loss[0] / avg_loss[1]))
+                        avg=avg_loss[0] / avg_loss[1],
+                        rate=tokens_per_step / (input_time + compute_time),
+                        input=input_time,
+                        compute=compute_time))
 
                 counter += 1
         except KeyboardInterrupt: